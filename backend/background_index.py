@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Persistent index of uploaded custom backgrounds
+
+A JSON manifest records each background's ID, content hash, file, stored
+dimensions and upload count. It is kept outside the directory served to clients,
+which holds only the images. The server reads it at startup and registers every background from the metadata
+alone; an image is only decoded when a stream first uses it. The manifest is
+rewritten atomically (temp file, then rename) so a crash never leaves it torn.
+"""
+
+import hashlib
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILENAME = "index.json"
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+
+
+class BackgroundRecord(NamedTuple):
+    """Metadata of one stored custom background"""
+    background_id: str
+    sha256: str
+    filename: str  # Relative to the backgrounds directory
+    width: int
+    height: int
+    references: int = 1  # Uploads sharing this background
+    created: float = 0.0
+
+
+class BackgroundIndex:
+    """Custom background metadata kept in memory and mirrored to a JSON manifest"""
+
+    def __init__(self, directory: str, path: str):
+        """Index the backgrounds stored in directory, keeping the manifest at path"""
+        self.directory = directory
+        self.path = path
+        self._records: Dict[str, BackgroundRecord] = {}
+        self._lock = threading.Lock()
+
+    def load(self) -> List[BackgroundRecord]:
+        """Read the manifest, or index the directory's existing uploads if there is none or it is unreadable"""
+        records: Optional[List[BackgroundRecord]] = None
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, encoding="utf-8") as manifest:
+                    records = [BackgroundRecord(**entry) for entry in json.load(manifest)["backgrounds"]]
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                # A torn or foreign manifest must not keep the server from starting: rebuild it from the files
+                logger.error(f"Unreadable background index {self.path}, re-indexing {self.directory}: {e}")
+        rebuilt = records is None
+        if rebuilt:
+            records = self._scan()
+
+        # Entries whose file was removed by hand are dropped rather than served as broken backgrounds
+        present = [record for record in records if os.path.exists(self.file_path(record))]
+        with self._lock:
+            self._records = {record.background_id: record for record in present}
+        if rebuilt or len(present) != len(records):
+            self.save()
+        logger.info(f"Background index loaded: {len(present)} backgrounds "
+                    f"({len(records) - len(present)} missing files dropped)")
+        return present
+
+    def _scan(self) -> List[BackgroundRecord]:
+        """Index uploads stored before there was a manifest, reading only their image headers"""
+        records = []
+        for filename in sorted(os.listdir(self.directory)):
+            background_id, extension = os.path.splitext(filename)
+            if not background_id.startswith("custom_") or extension.lower() not in IMAGE_EXTENSIONS:
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                with Image.open(path) as image:
+                    width, height = image.size
+                with open(path, "rb") as source:
+                    digest = hashlib.sha256(source.read()).hexdigest()
+            except OSError as e:
+                logger.warning(f"Skipping unreadable background {filename}: {e}")
+                continue
+            records.append(BackgroundRecord(background_id, digest, filename, width, height,
+                                            created=os.path.getmtime(path)))
+        return records
+
+    def file_path(self, record: BackgroundRecord) -> str:
+        """Path of a record's image file"""
+        return os.path.join(self.directory, record.filename)
+
+    def get(self, background_id: str) -> Optional[BackgroundRecord]:
+        """Look up a background's record"""
+        return self._records.get(background_id)
+
+    def page(self, offset: int, limit: int) -> List[BackgroundRecord]:
+        """Return up to limit records in upload order, starting at offset"""
+        with self._lock:
+            return list(itertools.islice(self._records.values(), offset, offset + limit))
+
+    def __len__(self) -> int:
+        """Number of indexed backgrounds"""
+        return len(self._records)
+
+    def put(self, record: BackgroundRecord) -> None:
+        """Add or update a record in memory; call save() to persist it"""
+        with self._lock:
+            if not record.created:
+                record = record._replace(created=time.time())
+            self._records[record.background_id] = record
+
+    def remove(self, background_id: str) -> Optional[BackgroundRecord]:
+        """Drop a record in memory; call save() to persist it"""
+        with self._lock:
+            return self._records.pop(background_id, None)
+
+    def save(self) -> None:
+        """Write the manifest atomically (blocking; run it off the event loop)"""
+        with self._lock:
+            entries = [record._asdict() for record in self._records.values()]
+            temporary_path = f"{self.path}.tmp"
+            with open(temporary_path, "w", encoding="utf-8") as manifest:
+                json.dump({"version": 1, "backgrounds": entries}, manifest, indent=1)
+            os.replace(temporary_path, self.path)
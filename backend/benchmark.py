@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+"""
+Benchmark script for the background replacement server
+
+Usage:
+    python benchmark.py            # run every benchmark
+    python benchmark.py startup    # run only the named benchmark(s)
+
+The "load" benchmark needs a running server (python main.py); point it
+elsewhere with BENCHMARK_SERVER=ws://host:port/ws.
+"""
+
+import asyncio
+import base64
+import json
+import os
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from main import BLUR_LEVELS, QUALITY_EDGE_MODES, BackgroundReplacer, StreamSession
+from segmentation import MediaPipeSegmenter, segmenter_factory
+
+GENERATORS = ['office', 'nature', 'space', 'beach', 'gradient', 'abstract']
+RESOLUTIONS = [(640, 480), (1280, 720), (1920, 1080)]
+SERVER_URL = os.environ.get("BENCHMARK_SERVER", "ws://localhost:8000/ws")
+LOAD_SOCKETS = [1, 2, 4, 8]
+LOAD_DURATION = 5.0  # seconds per step
+POOL_SIZES = sorted({1, 2, 4, os.cpu_count() or 1})
+POOL_DURATION = 3.0  # seconds per pool size
+INFERENCE_RESOLUTIONS = [(1280, 720), (1920, 1080), (3840, 2160)]
+INFERENCE_MODES = [(0, 'bilinear'), (640, 'bilinear'), (640, 'guided'), (256, 'bilinear')]
+KEYFRAME_INTERVALS = [1, 3, 5, 10]
+KEYFRAME_FRAMES = 60  # frames per interval
+MASK_DECAYS = [0.0, 0.5, 0.8]
+QUALITY_LEVELS = ['medium', 'high', 'ultra']
+BLUR_RESOLUTIONS = RESOLUTIONS + [(3840, 2160)]
+BACKEND_BATCH_SIZES = [1, 4]
+BATCH_SESSIONS = 8
+BATCH_DEADLINES_MS = [0, 2, 5, 10]
+
+
+def _time_call(func, repeat: int = 5) -> float:
+    """Return the best wall-clock time of `repeat` calls, in milliseconds"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def benchmark_startup():
+    """Time BackgroundReplacer.__init__ and each procedural background generator"""
+    print("⏱️  Startup benchmark")
+    print("-" * 40)
+
+    init_ms = _time_call(BackgroundReplacer, repeat=3)
+    print(f"BackgroundReplacer.__init__: {init_ms:8.1f} ms")
+
+    replacer = BackgroundReplacer()
+    print("  " + " " * 10 + "".join(f"{f'{w}x{h}':>14}" for w, h in RESOLUTIONS))
+    for name in GENERATORS:
+        generator = getattr(replacer, f"_create_{name}_background")
+        timings = [_time_call(lambda: generator(w, h)) for w, h in RESOLUTIONS]
+        print(f"  {name:<10}" + "".join(f"{t:11.2f} ms" for t in timings))
+
+
+def _synthetic_frame(width: int = 640, height: int = 480) -> np.ndarray:
+    """Create a camera-like test frame: a head-and-shoulders shape over a gradient"""
+    replacer = BackgroundReplacer.__new__(BackgroundReplacer)
+    frame = replacer._create_gradient_background(width, height)
+    cv2.ellipse(frame, (width // 2, height), (width // 3, height // 3), 0, 180, 360, (60, 90, 140), -1)
+    cv2.circle(frame, (width // 2, height // 2), height // 6, (120, 150, 200), -1)
+    return frame
+
+
+async def _stream_frames(frame_data: str, deadline: float) -> int:
+    """Send frames over one socket in a closed loop until the deadline; return frames received"""
+    import websockets
+
+    received = 0
+    async with websockets.connect(SERVER_URL, max_size=None) as ws:
+        await ws.send(json.dumps({"type": "set_background", "background": "blur"}))
+        await ws.recv()
+        while time.perf_counter() < deadline:
+            await ws.send(json.dumps({"type": "frame", "data": frame_data}))
+            response = json.loads(await ws.recv())
+            if response.get("type") == "processed_frame":
+                received += 1
+    return received
+
+
+async def _run_load(frame_data: str, sockets: int) -> float:
+    """Run `sockets` concurrent streams and return the aggregate FPS"""
+    start = time.perf_counter()
+    counts = await asyncio.gather(*[_stream_frames(frame_data, start + LOAD_DURATION) for _ in range(sockets)])
+    return sum(counts) / (time.perf_counter() - start)
+
+
+def benchmark_load():
+    """Measure aggregate FPS against a running server as concurrent sockets increase"""
+    print(f"⏱️  Load test against {SERVER_URL}")
+    print("-" * 40)
+
+    _, buffer = cv2.imencode('.jpg', _synthetic_frame())
+    frame_data = base64.b64encode(buffer).decode('utf-8')
+
+    baseline = None
+    for sockets in LOAD_SOCKETS:
+        try:
+            fps = asyncio.run(_run_load(frame_data, sockets))
+        except OSError as e:
+            print(f"❌ Could not reach the server: {e}")
+            return
+        baseline = baseline or fps
+        print(f"  {sockets:>2} sockets: {fps:7.1f} FPS aggregate ({fps / sockets:6.1f} per socket, {fps / baseline:4.2f}x)")
+
+
+def benchmark_pool():
+    """Measure in-process frame throughput as the segmenter pool grows"""
+    print(f"⏱️  Segmenter pool throughput (640x480, blur, {os.cpu_count()} cores)")
+    print("-" * 40)
+
+    frame = _synthetic_frame()
+    baseline = None
+    for size in POOL_SIZES:
+        replacer = BackgroundReplacer(pool_size=size)
+
+        def worker(_) -> int:
+            session = StreamSession('blur')
+            frames = 0
+            deadline = time.perf_counter() + POOL_DURATION
+            while time.perf_counter() < deadline:
+                replacer.process_frame(frame, session)
+                frames += 1
+            return frames
+
+        with ThreadPoolExecutor(max_workers=size) as executor:
+            # Warm up so graph creation is not counted
+            list(executor.map(lambda _: replacer.process_frame(frame, StreamSession('blur')), range(size)))
+            start = time.perf_counter()
+            total = sum(executor.map(worker, range(size)))
+            fps = total / (time.perf_counter() - start)
+
+        baseline = baseline or fps
+        print(f"  pool size {size:>2}: {fps:7.1f} FPS ({fps / baseline:4.2f}x)")
+
+
+def _legacy_composite(frame: np.ndarray, segmentation_mask: np.ndarray, background: np.ndarray) -> np.ndarray:
+    """The original 3-channel float compositing, kept as the benchmark baseline"""
+    mask = np.stack((segmentation_mask,) * 3, axis=-1)
+    mask = (mask > 0.5).astype(np.uint8)
+    result = frame * mask + background * (1 - mask)
+    return result.astype(np.uint8)
+
+
+def _allocated_bytes(func) -> int:
+    """Return the peak memory traced while running func once"""
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def benchmark_composite():
+    """Compare the legacy compositing kernel with the single-channel, preallocated one"""
+    print("⏱️  Compositing kernel (mask threshold + blend, per frame)")
+    print("-" * 40)
+
+    for width, height in RESOLUTIONS:
+        frame = _synthetic_frame(width, height)
+        background = np.zeros_like(frame)
+        segmentation_mask = np.random.rand(height, width).astype(np.float32)
+        state = {}
+
+        def kernel():
+            mask = cv2.compare(segmentation_mask, 0.5, cv2.CMP_GT,
+                               dst=BackgroundReplacer._buffer(state, 'mask', (height, width), np.uint8))
+            return BackgroundReplacer.composite(frame, mask, background,
+                                                BackgroundReplacer._buffer(state, 'output', frame.shape, np.uint8))
+
+        assert np.array_equal(kernel(), _legacy_composite(frame, segmentation_mask, background))
+        legacy_ms = _time_call(lambda: _legacy_composite(frame, segmentation_mask, background), repeat=10)
+        kernel_ms = _time_call(kernel, repeat=10)
+        legacy_bytes = _allocated_bytes(lambda: _legacy_composite(frame, segmentation_mask, background))
+        kernel_bytes = _allocated_bytes(kernel)
+        print(f"  {f'{width}x{height}':>9}: legacy {legacy_ms:6.2f} ms / {legacy_bytes / 1e6:6.1f} MB allocated, "
+              f"kernel {kernel_ms:6.2f} ms / {kernel_bytes / 1e6:6.3f} MB allocated")
+
+
+def benchmark_inference():
+    """Compare full-resolution inference with downscaled inference plus mask upsampling"""
+    print("⏱️  Segmentation + compositing per frame (office background)")
+    print("-" * 40)
+
+    replacers = {mode: BackgroundReplacer(pool_size=1, inference_width=mode[0], mask_upsampling=mode[1])
+                 for mode in INFERENCE_MODES}
+    print("  " + " " * 18 + "".join(f"{f'{w}x{h}':>14}" for w, h in INFERENCE_RESOLUTIONS))
+    for (inference_width, upsampling), replacer in replacers.items():
+        timings = []
+        for width, height in INFERENCE_RESOLUTIONS:
+            frame = _synthetic_frame(width, height)
+            session = StreamSession('office')
+            replacer.process_frame(frame, session)  # Warm up the graph and the cache
+            timings.append(_time_call(lambda: replacer.process_frame(frame, session)))
+        label = f"{inference_width or 'full'} {upsampling if inference_width else ''}"
+        print(f"  {label:<18}" + "".join(f"{t:11.2f} ms" for t in timings))
+
+
+def _moving_frames(width: int, height: int, count: int):
+    """Yield frames of the synthetic subject drifting sideways, like a person shifting in their seat"""
+    frame = _synthetic_frame(width, height)
+    for index in range(count):
+        shift = int(width * 0.05 * np.sin(index / 10))
+        yield np.roll(frame, shift, axis=1)
+
+
+def benchmark_keyframe():
+    """Measure per-frame segmentation cost as the keyframe interval grows"""
+    print("⏱️  Keyframe segmentation with optical-flow propagation (blur)")
+    print("-" * 40)
+
+    for width, height in RESOLUTIONS[:2]:
+        frames = list(_moving_frames(width, height, KEYFRAME_FRAMES))
+        for interval in KEYFRAME_INTERVALS:
+            replacer = BackgroundReplacer(pool_size=1, keyframe_interval=interval)
+            replacer._infer(frames[0], None)  # Warm up the graph without counting it
+            session = StreamSession('blur')
+            start = time.perf_counter()
+            for frame in frames:
+                replacer.process_frame(frame, session)
+            total_ms = (time.perf_counter() - start) * 1000 / len(frames)
+            stats = replacer.segmentation_stats()
+            print(f"  {f'{width}x{height}':>9} K={interval:<2}: {stats['per_frame_ms']:6.2f} ms segmentation, "
+                  f"{total_ms:6.2f} ms total per frame ({stats['keyframes']} keyframes, "
+                  f"{stats['propagated_ms']:5.2f} ms per propagated frame)")
+
+
+def benchmark_smoothing():
+    """Measure silhouette flicker and smoothing cost for several mask decays"""
+    print("⏱️  Temporal mask smoothing (static subject with sensor noise, 640x480)")
+    print("-" * 40)
+
+    frame = _synthetic_frame()
+    rng = np.random.default_rng(0)
+    frames = [cv2.add(frame, rng.integers(0, 12, frame.shape, dtype=np.uint8)) for _ in range(KEYFRAME_FRAMES)]
+    mask = np.random.rand(360, 640).astype(np.float32)
+
+    for decay in MASK_DECAYS:
+        replacer = BackgroundReplacer(pool_size=1, mask_decay=decay)
+        session = StreamSession('blur')
+        flips = []
+        previous = None
+        for noisy in frames:
+            binary = replacer.segment(noisy, session) > 0.5
+            if previous is not None:
+                flips.append(np.count_nonzero(binary != previous))
+            previous = binary
+        timing_session = StreamSession('blur')
+        smooth_ms = _time_call(lambda: replacer._smooth_mask(mask, timing_session), repeat=20)
+        print(f"  decay {decay:.1f}: {np.mean(flips):7.1f} mask pixels flip per frame, "
+              f"{smooth_ms:5.2f} ms to smooth a 640x360 mask")
+
+
+def benchmark_edges():
+    """Compare the binary compositing path with soft-alpha matting at each client quality level"""
+    print("⏱️  Edge quality per frame (office background, edgeSmoothing 85)")
+    print("-" * 40)
+
+    replacer = BackgroundReplacer(pool_size=1)
+    print("  " + " " * 18 + "".join(f"{f'{w}x{h}':>14}" for w, h in RESOLUTIONS))
+    frames = {(w, h): _synthetic_frame(w, h) for w, h in RESOLUTIONS}
+    for quality in QUALITY_LEVELS:
+        timings = []
+        for width, height in RESOLUTIONS:
+            session = StreamSession('office')
+            session.update_settings({'quality': quality, 'edgeSmoothing': 85})
+            frame = frames[(width, height)]
+            replacer.process_frame(frame, session)  # Warm up the graph and the cache
+            timings.append(_time_call(lambda: replacer.process_frame(frame, session)))
+        label = f"{quality} ({QUALITY_EDGE_MODES[quality]})"
+        print(f"  {label:<18}" + "".join(f"{t:11.2f} ms" for t in timings))
+
+    # The blend kernels alone, on a feathered silhouette
+    binary_timings, soft_timings = [], []
+    for width, height in RESOLUTIONS:
+        frame = frames[(width, height)]
+        background = np.zeros_like(frame)
+        mask = np.zeros((height, width), dtype=np.float32)
+        cv2.ellipse(mask, (width // 2, height), (width // 3, height * 2 // 3), 0, 0, 360, 1.0, -1)
+        mask = cv2.GaussianBlur(mask, (0, 0), width / 200)
+        binary = cv2.compare(mask, 0.5, cv2.CMP_GT)
+        alpha = np.multiply(mask, 256, casting='unsafe', out=np.empty(mask.shape, np.uint16))
+        out = np.empty_like(frame)
+        binary_timings.append(_time_call(lambda: BackgroundReplacer.composite(frame, binary, background, out), 10))
+        soft_timings.append(_time_call(lambda: BackgroundReplacer.composite_soft(frame, alpha, background, out), 10))
+    print(f"  {'binary blend':<18}" + "".join(f"{t:11.2f} ms" for t in binary_timings))
+    print(f"  {'soft blend':<18}" + "".join(f"{t:11.2f} ms" for t in soft_timings))
+
+
+def benchmark_blur():
+    """Compare the full-resolution Gaussian blur with the pyramid blur at each strength"""
+    print("⏱️  Blur background per frame")
+    print("-" * 40)
+
+    frames = [_synthetic_frame(w, h) for w, h in BLUR_RESOLUTIONS]
+    print("  " + " " * 18 + "".join(f"{f'{w}x{h}':>14}" for w, h in BLUR_RESOLUTIONS))
+    timings = [_time_call(lambda: cv2.GaussianBlur(frame, (21, 21), 0), 10) for frame in frames]
+    print(f"  {'gaussian 21x21':<18}" + "".join(f"{t:11.2f} ms" for t in timings))
+
+    replacer = BackgroundReplacer.__new__(BackgroundReplacer)
+    replacer.blur_reuse_threshold = 0
+    for strength in BLUR_LEVELS:
+        replacer.blur_strength = strength
+        timings = []
+        for frame in frames:
+            session = StreamSession('blur')
+            timings.append(_time_call(lambda: replacer.blur_background(frame, session), 10))
+        print(f"  {'pyramid ' + strength:<18}" + "".join(f"{t:11.2f} ms" for t in timings))
+
+    # Static camera: every frame after the first reuses the blurred background
+    replacer.blur_strength = 'medium'
+    replacer.blur_reuse_threshold = 2.0
+    replacer.blur_reuses = 0
+    timings = []
+    for frame in frames:
+        session = StreamSession('blur')
+        replacer.blur_background(frame, session)
+        timings.append(_time_call(lambda: replacer.blur_background(frame, session), 10))
+    print(f"  {'static camera':<18}" + "".join(f"{t:11.2f} ms" for t in timings))
+
+
+def benchmark_backends():
+    """Compare per-frame inference cost of the segmentation backends"""
+    print("⏱️  Segmentation backends (640x480 RGB, per frame)")
+    print("-" * 40)
+
+    rgb = cv2.cvtColor(_synthetic_frame(), cv2.COLOR_BGR2RGB)
+    engines = {'mediapipe': MediaPipeSegmenter()}
+    model_path = os.environ.get("ONNX_MODEL_PATH")
+    if model_path:
+        for threads in sorted({1, os.cpu_count() or 1}):
+            engines[f'onnx ({threads} threads)'] = segmenter_factory('onnx', model_path, threads)()
+    else:
+        print("  (set ONNX_MODEL_PATH to include the onnx backend)")
+
+    for name, engine in engines.items():
+        timings = []
+        for batch_size in BACKEND_BATCH_SIZES:
+            batch = [rgb] * batch_size
+            engine.process(batch)
+            timings.append(_time_call(lambda: engine.process(batch), 10) / batch_size)
+        print(f"  {name:<18}" + "".join(f"  batch {size}: {t:6.2f} ms" for size, t in zip(BACKEND_BATCH_SIZES, timings)))
+
+
+def benchmark_batching():
+    """Measure throughput and added latency of cross-session batching as the deadline grows"""
+    backend = 'onnx' if os.environ.get("ONNX_MODEL_PATH") else 'mediapipe'
+    print(f"⏱️  Batched inference, {BATCH_SESSIONS} concurrent sessions (640x480, {backend})")
+    print("-" * 40)
+
+    frame = _synthetic_frame()
+    for deadline_ms in BATCH_DEADLINES_MS:
+        replacer = BackgroundReplacer(segmentation_backend=backend, batch_deadline_ms=deadline_ms)
+        replacer._infer(frame, None)  # Warm up the segmenter
+
+        def session_loop(_) -> int:
+            session = StreamSession('office')
+            frames = 0
+            deadline = time.perf_counter() + POOL_DURATION
+            while time.perf_counter() < deadline:
+                replacer.segment(frame, session)
+                frames += 1
+            return frames
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=BATCH_SESSIONS) as executor:
+            total = sum(executor.map(session_loop, range(BATCH_SESSIONS)))
+        fps = total / (time.perf_counter() - start)
+
+        if replacer.inference_scheduler is None:
+            print(f"  unbatched : {fps:7.1f} FPS")
+            continue
+        stats = replacer.inference_scheduler.stats()
+        replacer.inference_scheduler.shutdown()
+        print(f"  {deadline_ms:>3} ms    : {fps:7.1f} FPS, wait {stats['avg_wait_ms']:5.2f} ms avg / "
+              f"{stats['max_wait_ms']:6.2f} ms max, batch sizes {stats['batch_sizes']}")
+
+
+BENCHMARKS = {
+    'startup': benchmark_startup,
+    'composite': benchmark_composite,
+    'pool': benchmark_pool,
+    'inference': benchmark_inference,
+    'keyframe': benchmark_keyframe,
+    'smoothing': benchmark_smoothing,
+    'edges': benchmark_edges,
+    'blur': benchmark_blur,
+    'backends': benchmark_backends,
+    'batching': benchmark_batching,
+    'load': benchmark_load,
+}
+
+
+def main():
+    """Run the selected benchmarks"""
+    selected = sys.argv[1:] or list(BENCHMARKS)
+    unknown = [name for name in selected if name not in BENCHMARKS]
+    if unknown:
+        print(f"❌ Unknown benchmark(s): {', '.join(unknown)}. Available: {', '.join(BENCHMARKS)}")
+        sys.exit(1)
+
+    print("🧪 Real-time AI Background Replacement - Benchmarks")
+    print("=" * 60)
+    for name in selected:
+        BENCHMARKS[name]()
+        print()
+
+
+if __name__ == "__main__":
+    main()
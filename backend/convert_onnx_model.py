@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Export MediaPipe's selfie segmentation model to ONNX for SEGMENTATION_BACKEND=onnx
+
+Usage (needs tf2onnx, tensorflow and onnx, e.g. in a separate virtualenv):
+    python convert_onnx_model.py [model.tflite] [output.onnx]
+
+The model path defaults to the landscape model bundled with mediapipe. Its one
+MediaPipe-specific op, Convolution2DTransposeBias, is rewritten as a standard
+ConvTranspose so ONNX Runtime can run the result, and the batch dimension is
+made dynamic so frames from several sessions can be segmented in one call.
+"""
+
+import os
+import sys
+
+import numpy as np
+import onnx
+import tf2onnx
+from onnx import helper, numpy_helper
+
+DEFAULT_OUTPUT = "models/selfie_segmentation_landscape.onnx"
+
+
+def _bundled_model() -> str:
+    """Find the landscape model inside the installed mediapipe package"""
+    import importlib.util
+
+    spec = importlib.util.find_spec("mediapipe")
+    if spec is None:
+        sys.exit("❌ mediapipe is not installed here; pass the .tflite path explicitly")
+    return os.path.join(os.path.dirname(spec.origin), "modules", "selfie_segmentation",
+                        "selfie_segmentation_landscape.tflite")
+
+
+def _replace_transpose_bias(model: onnx.ModelProto) -> None:
+    """Rewrite Convolution2DTransposeBias (NHWC, OHWI kernel, stride 2) as ConvTranspose"""
+    graph = model.graph
+    initializers = {tensor.name: tensor for tensor in graph.initializer}
+    producers = {output: node for node in graph.node for output in node.output}
+
+    for node in [node for node in graph.node if node.op_type.endswith("Convolution2DTransposeBias")]:
+        data, kernel_name, bias = node.input
+        kernel = numpy_helper.to_array(initializers[kernel_name])
+        graph.initializer.append(numpy_helper.from_array(
+            np.ascontiguousarray(kernel.transpose(3, 0, 1, 2)), f"{node.name}_weight"))
+
+        # tf2onnx feeds the op NHWC through a Transpose; take the NCHW tensor before it
+        source = producers.get(data)
+        if source is not None and source.op_type == "Transpose" and list(source.attribute[0].ints) == [0, 2, 3, 1]:
+            data = source.input[0]
+        else:
+            nchw = helper.make_node("Transpose", [data], [f"{node.name}_nchw_input"], perm=[0, 3, 1, 2])
+            data = nchw.output[0]
+            graph.node.insert(list(graph.node).index(node), nchw)
+
+        index = list(graph.node).index(node)
+        graph.node.remove(node)
+        graph.node.insert(index, helper.make_node(
+            "ConvTranspose", [data, f"{node.name}_weight", bias], [f"{node.name}_nchw"],
+            name=f"{node.name}_conv", strides=[2, 2], kernel_shape=list(kernel.shape[1:3])))
+        graph.node.insert(index + 1, helper.make_node(
+            "Transpose", [f"{node.name}_nchw"], list(node.output), name=f"{node.name}_nhwc", perm=[0, 2, 3, 1]))
+
+    # Drop the NHWC transpose and OHWI kernel the rewritten ops no longer read
+    used = {name for node in graph.node for name in node.input} | {output.name for output in graph.output}
+    for node in [node for node in graph.node if node.op_type == "Transpose" and not set(node.output) & used]:
+        graph.node.remove(node)
+    used = {name for node in graph.node for name in node.input}
+    for tensor in [tensor for tensor in graph.initializer if tensor.name not in used]:
+        graph.initializer.remove(tensor)
+
+
+def _make_batch_dynamic(model: onnx.ModelProto) -> None:
+    """Turn the exported batch size of 1 into a symbolic dimension"""
+    graph = model.graph
+    for value in list(graph.input) + list(graph.output):
+        value.type.tensor_type.shape.dim[0].dim_param = "batch"
+
+    # Reshapes were exported with a literal batch of 1; 0 copies the input's batch instead
+    initializers = {tensor.name: tensor for tensor in graph.initializer}
+    rewritten = {}
+    for node in graph.node:
+        if node.op_type != "Reshape" or node.input[1] not in initializers:
+            continue
+        if node.input[1] not in rewritten:
+            shape = numpy_helper.to_array(initializers[node.input[1]]).copy()
+            if shape[0] != 1:
+                continue
+            shape[0] = 0
+            rewritten[node.input[1]] = f"{node.input[1]}_any_batch"
+            graph.initializer.append(numpy_helper.from_array(shape, rewritten[node.input[1]]))
+        node.input[1] = rewritten[node.input[1]]
+
+    used = {name for node in graph.node for name in node.input}
+    for tensor in [tensor for tensor in graph.initializer if tensor.name not in used]:
+        graph.initializer.remove(tensor)
+
+
+def main():
+    """Convert, patch and save the model"""
+    tflite_path = sys.argv[1] if len(sys.argv) > 1 else _bundled_model()
+    output_path = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_OUTPUT
+
+    print(f"🔄 Converting {tflite_path}")
+    model, _ = tf2onnx.convert.from_tflite(tflite_path, opset=14)
+    _replace_transpose_bias(model)
+    _make_batch_dynamic(model)
+    onnx.checker.check_model(model)
+
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    onnx.save(model, output_path)
+    print(f"✅ Saved {output_path}; run the server with SEGMENTATION_BACKEND=onnx ONNX_MODEL_PATH={output_path}")
+
+
+if __name__ == "__main__":
+    main()
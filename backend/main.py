@@ -6,226 +6,1002 @@ Main server file with FastAPI and WebSocket support
 
 import asyncio
 import base64
+import hashlib
+import heapq
+import io
+import itertools
 import json
 import logging
+import math
+import multiprocessing
 import os
+import struct
+import sys
+import threading
+import time
 import uuid
-from typing import Optional, Dict, Any
+import zlib
+from contextlib import asynccontextmanager
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import AsyncIterator, Callable, List, NamedTuple, Optional, Dict, Any, Tuple, Union
 import cv2
 import numpy as np
-import mediapipe as mp
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, UploadFile, File
+from PIL import Image
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
+from multipart.multipart import MultipartParser, parse_options_header
 import uvicorn
 
+from segmentation import (InferenceScheduler, SegmenterPool, flow_guide, guided_filter, guided_upsample,
+                          propagate_mask, segmenter_factory)
+from background_index import INDEX_FILENAME, BackgroundIndex, BackgroundRecord
+from worker_pool import SharedMemoryWorkerPool
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Memory budget for backgrounds rendered/resized to stream resolutions
+BACKGROUND_CACHE_BYTES = int(os.environ.get("BACKGROUND_CACHE_MB", "256")) * 1024 * 1024
+
+# Background uploads are read into memory as they stream in and refused above MAX_UPLOAD_MB
+# (plus UPLOAD_FORM_OVERHEAD for the multipart framing) or MAX_UPLOAD_MEGAPIXELS;
+# UPLOAD_WORKERS threads do the hashing, decoding and file I/O
+MAX_UPLOAD_BYTES = int(float(os.environ.get("MAX_UPLOAD_MB", "20")) * 1024 * 1024)
+MAX_UPLOAD_PIXELS = int(float(os.environ.get("MAX_UPLOAD_MEGAPIXELS", "40")) * 1_000_000)
+UPLOAD_FORM_OVERHEAD = 64 * 1024
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", "2"))
+
+# Uploaded backgrounds are stored no larger than MAX_BACKGROUND_RESOLUTION (either orientation)
+# and rendered ahead of time at the comma-separated PRERENDER_RESOLUTIONS
+MAX_BACKGROUND_RESOLUTION = os.environ.get("MAX_BACKGROUND_RESOLUTION", "3840x2160")
+PRERENDER_RESOLUTIONS = os.environ.get("PRERENDER_RESOLUTIONS", "640x480,1280x720,1920x1080")
+
+# Upload manifest and in-progress upload files, kept out of the statically served backgrounds/
+# directory; it must be on the same filesystem so finished uploads can be renamed into place
+BACKGROUND_DATA_DIR = os.environ.get("BACKGROUND_DATA_DIR", "background_data")
+
+# Custom backgrounds per /backgrounds/list page unless the request sets a limit
+BACKGROUND_PAGE_SIZE = int(os.environ.get("BACKGROUND_PAGE_SIZE", "100"))
+
+# Pool running the CPU-bound decode -> segment -> composite -> encode stage
+# ("thread", "process" or "shared_memory")
+FRAME_EXECUTOR = os.environ.get("FRAME_EXECUTOR", "thread")
+FRAME_WORKERS = int(os.environ.get("FRAME_WORKERS", str(os.cpu_count() or 4)))
+
+# Shared-memory ring size per worker: largest frame (WIDTHxHEIGHT) and slots in flight
+SHM_MAX_FRAME = os.environ.get("SHM_MAX_FRAME", "1920x1080")
+SHM_SLOTS_PER_WORKER = int(os.environ.get("SHM_SLOTS_PER_WORKER", "2"))
+
+# MediaPipe graphs available for concurrent inference (created on demand)
+SEGMENTER_POOL_SIZE = int(os.environ.get("SEGMENTER_POOL_SIZE", str(os.cpu_count() or 4)))
+
+# Segmentation engine: "mediapipe" or "onnx" (needs onnxruntime and a local model file).
+# ONNX_THREADS is ONNX Runtime's intra-op thread count per segmenter (0 = one per core)
+SEGMENTATION_BACKEND = os.environ.get("SEGMENTATION_BACKEND", "mediapipe")
+ONNX_MODEL_PATH = os.environ.get("ONNX_MODEL_PATH")
+ONNX_THREADS = int(os.environ.get("ONNX_THREADS", "0"))
+
+# With INFERENCE_BATCH_MS > 0, frames from all sessions are gathered for up to that long and
+# segmented together, at most INFERENCE_MAX_BATCH at a time (pays off with a batch-capable backend)
+INFERENCE_BATCH_MS = float(os.environ.get("INFERENCE_BATCH_MS", "0"))
+INFERENCE_MAX_BATCH = int(os.environ.get("INFERENCE_MAX_BATCH", "8"))
+
+# Frames wider than this are downscaled before inference (0 = always full resolution);
+# the mask is then upsampled with "bilinear" or edge-aware "guided" filtering
+INFERENCE_WIDTH = int(os.environ.get("INFERENCE_WIDTH", "640"))
+MASK_UPSAMPLING = os.environ.get("MASK_UPSAMPLING", "bilinear")
+
+# Run the model every KEYFRAME_INTERVAL frames (1 = every frame) and propagate the mask with
+# optical flow in between; a mean gray-level change above SCENE_CHANGE_THRESHOLD forces a keyframe
+KEYFRAME_INTERVAL = int(os.environ.get("KEYFRAME_INTERVAL", "1"))
+SCENE_CHANGE_THRESHOLD = float(os.environ.get("SCENE_CHANGE_THRESHOLD", "20"))
+
+# Weight of the previous frames in each session's running mask average (0 = no temporal smoothing)
+MASK_DECAY = float(os.environ.get("MASK_DECAY", "0.5"))
+
+# Edge treatment per client quality setting; frames without one keep the binary mask.
+# settings.edgeSmoothing (0-100) scales the feather/guided-filter radius up to MAX_EDGE_RADIUS
+# pixels at 640 wide, and soft masks are blended only in BLEND_TILE-pixel tiles along the edge
+QUALITY_EDGE_MODES = {'medium': 'binary', 'high': 'feather', 'ultra': 'guided'}
+MAX_EDGE_RADIUS = 8
+BLEND_TILE = 64
+
+# Blur strengths as (pyrDown levels, Gaussian kernel at the smallest level) for a 640-wide frame;
+# wider frames get an extra level per doubling so the blur looks the same at any resolution.
+# With BLUR_REUSE_THRESHOLD > 0 a session keeps its last blurred background while the downscaled
+# frame changes by less than that mean gray level (a static camera)
+BLUR_LEVELS = {'low': (1, 5), 'medium': (2, 5), 'high': (3, 7)}
+BLUR_STRENGTH = os.environ.get("BLUR_STRENGTH", "medium")
+BLUR_REUSE_THRESHOLD = float(os.environ.get("BLUR_REUSE_THRESHOLD", "0"))
+
+# Per-session latency target in ms (0 = off; clients can set one with a targetLatency setting).
+# Sessions over target step down QUALITY_LEVELS, each (output quality, maximum inference width,
+# minimum keyframe interval) applied on top of the session's own settings with None meaning no
+# limit, so a level never raises the cost of a frame; they step back up once there is headroom
+TARGET_LATENCY_MS = float(os.environ.get("TARGET_LATENCY_MS", "0"))
+QUALITY_LEVELS = ((None, None, None), (80, 512, None), (70, 384, 2), (60, 320, 3), (50, 256, 4))
+
+# Binary /ws frames: message type, codec, sequence number, client timestamp (ms), then the image bytes
+FRAME_HEADER = struct.Struct("!BBId")
+MSG_FRAME = 1
+MSG_PROCESSED_FRAME = 2
+CODEC_IDS = {'jpeg': 1, 'webp': 2}
+CODEC_NAMES = {codec_id: name for name, codec_id in CODEC_IDS.items()}
+CODEC_EXTENSIONS = {'jpeg': '.jpg', 'webp': '.webp'}
+
+# Frames waiting per connection; when full the oldest is dropped so latency stays bounded
+FRAME_MAILBOX_SLOTS = int(os.environ.get("FRAME_MAILBOX_SLOTS", "1"))
+
+# At most MAX_STREAMS concurrent /ws streams (0 = unlimited). Further connections either wait
+# up to ADMISSION_TIMEOUT seconds for a free stream ("queue") or are closed at once ("reject")
+MAX_STREAMS = int(os.environ.get("MAX_STREAMS", "0"))
+ADMISSION_POLICY = os.environ.get("ADMISSION_POLICY", "queue")
+ADMISSION_TIMEOUT = float(os.environ.get("ADMISSION_TIMEOUT", "30"))
+
+class FrameHeader(NamedTuple):
+    """Fixed header of a binary /ws frame message"""
+    message_type: int
+    codec: str
+    sequence: int
+    timestamp: float
+
+def pack_frame(header: FrameHeader, image_bytes: bytes) -> bytes:
+    """Build a binary frame message from a header and compressed image bytes"""
+    return FRAME_HEADER.pack(header.message_type, CODEC_IDS[header.codec],
+                             header.sequence, header.timestamp) + image_bytes
+
+def unpack_frame(data: bytes) -> Tuple[FrameHeader, memoryview]:
+    """Split a binary frame message into its header and a view of the image bytes"""
+    if len(data) <= FRAME_HEADER.size:
+        raise ValueError("Binary frame is too short")
+    message_type, codec_id, sequence, timestamp = FRAME_HEADER.unpack_from(data)
+    if codec_id not in CODEC_NAMES:
+        raise ValueError(f"Unknown codec id: {codec_id}")
+    return FrameHeader(message_type, CODEC_NAMES[codec_id], sequence, timestamp), memoryview(data)[FRAME_HEADER.size:]
+
+class BackgroundCache:
+    """LRU cache of ready-to-composite backgrounds under a byte budget"""
+    
+    def __init__(self, max_bytes: int = BACKGROUND_CACHE_BYTES):
+        """Initialize an empty cache holding at most max_bytes of images"""
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.prefilled = 0  # Entries added ahead of use by prefill()
+        self._entries: "OrderedDict[Tuple[str, int, int, str], np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, background_id: str, height: int, width: int, dtype: Any,
+            factory: Callable[[], np.ndarray]) -> np.ndarray:
+        """Return the cached image for the key, building it with factory on a miss"""
+        key = (background_id, height, width, np.dtype(dtype).str)
+        with self._lock:
+            image = self._entries.get(key)
+            if image is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return image
+            self.misses += 1
+        
+        # Build outside the lock so a slow render does not block other streams
+        image = factory()
+        if image.nbytes > self.max_bytes:
+            return image
+        
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = image
+                self.current_bytes += image.nbytes
+                while self.current_bytes > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self.current_bytes -= evicted.nbytes
+                    self.evictions += 1
+        return image
+    
+    def prefill(self, background_id: str, height: int, width: int, dtype: Any, nbytes: int,
+                factory: Callable[[], np.ndarray]) -> bool:
+        """Cache an image that nothing has asked for yet, only if it fits without evicting anything
+        
+        It goes in as least recently used, so it is the first to go when live streams need room.
+        """
+        key = (background_id, height, width, np.dtype(dtype).str)
+        with self._lock:
+            if key in self._entries or self.current_bytes + nbytes > self.max_bytes:
+                return False
+        
+        image = factory()
+        with self._lock:
+            if key in self._entries or self.current_bytes + image.nbytes > self.max_bytes:
+                return False
+            self._entries[key] = image
+            self._entries.move_to_end(key, last=False)
+            self.current_bytes += image.nbytes
+            self.prefilled += 1
+        return True
+    
+    def invalidate(self, background_id: str) -> None:
+        """Drop every cached resolution of a background"""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == background_id]:
+                self.current_bytes -= self._entries.pop(key).nbytes
+    
+    def stats(self) -> Dict[str, Any]:
+        """Return cache counters for monitoring"""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "prefilled": self.prefilled,
+            }
+
+def _parse_blur_strength(value: Any) -> str:
+    """Validate a client's blurStrength setting"""
+    if value not in BLUR_LEVELS:
+        raise ValueError(value)
+    return value
+
+def _parse_inference_width(value: Any) -> int:
+    """Validate a client's inferenceWidth setting: 0 for full resolution, otherwise at least 64 pixels"""
+    width = int(value)
+    if width < 0:
+        raise ValueError(value)
+    return max(width, 64) if width else 0
+
+class StreamSession:
+    """Per-connection stream state; the model and background caches stay shared in BackgroundReplacer"""
+    
+    # Client settings that override replacer defaults: setting name -> (attribute, parser)
+    SETTING_OVERRIDES: Dict[str, Tuple[str, Callable[[Any], Any]]] = {
+        'inferenceWidth': ('inference_width', _parse_inference_width),
+        'keyframeInterval': ('keyframe_interval', lambda value: max(1, int(value))),
+        'maskDecay': ('mask_decay', lambda value: min(max(float(value), 0.0), 0.99)),
+        'blurStrength': ('blur_strength', _parse_blur_strength),
+        'targetLatency': ('target_latency_ms', lambda value: max(0.0, float(value))),
+    }
+    
+    def __init__(self, background: str = 'none', session_id: Optional[str] = None):
+        """Create a session starting from the given background"""
+        self.session_id = session_id or uuid.uuid4().hex
+        self.background = background
+        self.settings: Dict[str, Any] = {}  # Latest client settings (quality, edgeSmoothing, ...)
+        self.inference_width: Optional[int] = None  # Overrides the replacer's inference width
+        self.keyframe_interval: Optional[int] = None  # Overrides the replacer's keyframe interval
+        self.mask_decay: Optional[float] = None  # Overrides the replacer's mask decay
+        self.blur_strength: Optional[str] = None  # Overrides the replacer's blur strength
+        # Limits from the adaptive quality controller, applied on top of the settings above
+        self.output_quality: Optional[int] = None  # JPEG/WebP quality of replies (None = OpenCV default)
+        self.max_inference_width: Optional[int] = None
+        self.min_keyframe_interval: Optional[int] = None
+        self.target_latency_ms = TARGET_LATENCY_MS
+        self.state: Dict[str, Any] = {}  # Runtime buffers, kept by whichever process renders the session
+    
+    def __getstate__(self) -> Dict[str, Any]:
+        """Pickle settings only; runtime buffers stay in the process that owns them"""
+        state = self.__dict__.copy()
+        state['state'] = {}
+        return state
+    
+    def update_settings(self, settings: Optional[Dict[str, Any]]) -> None:
+        """Merge settings sent by the client with a frame, in hello or in a settings message"""
+        if settings:
+            self.settings.update(settings)
+            for name, (attribute, parse) in self.SETTING_OVERRIDES.items():
+                if name in settings:
+                    try:
+                        setattr(self, attribute, parse(settings[name]))
+                    except (TypeError, ValueError):
+                        logger.warning(f"Ignoring invalid {name}: {settings[name]!r}")
+
+class QualityController:
+    """Per-session feedback loop that trades output quality for latency
+    
+    Latency is the server's receive-to-reply time plus any growth in the client's one-way delay,
+    measured as the client timestamp's offset from the receive time above its lowest seen value
+    (the clocks need not agree). Its moving average is compared with the session's target every
+    cooldown frames: above target the session moves one step down QUALITY_LEVELS, and below
+    headroom times the target one step back up.
+    """
+    
+    def __init__(self, levels: Tuple[Tuple[Optional[int], ...], ...] = QUALITY_LEVELS, smoothing: float = 0.2,
+                 cooldown: int = 10, headroom: float = 0.6):
+        """Start at the first (best) level"""
+        self.levels = levels
+        self.smoothing = smoothing
+        self.cooldown = cooldown
+        self.headroom = headroom
+        self.level = 0
+        self.latency_ms: Optional[float] = None
+        self.adjustments = 0
+        self._frames_since_change = 0
+        self._min_offset_ms: Optional[float] = None
+    
+    def observe(self, session: StreamSession, server_ms: float, client_timestamp: Optional[float] = None,
+                received: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """Record one frame's latency and return the new settings if the session's level changed"""
+        latency = server_ms
+        if isinstance(client_timestamp, (int, float)) and client_timestamp > 0 and received is not None:
+            offset = received * 1000 - client_timestamp
+            if self._min_offset_ms is None or offset < self._min_offset_ms:
+                self._min_offset_ms = offset
+            latency += offset - self._min_offset_ms
+        self.latency_ms = (latency if self.latency_ms is None
+                           else self.latency_ms + self.smoothing * (latency - self.latency_ms))
+        
+        self._frames_since_change += 1
+        target = session.target_latency_ms
+        if target <= 0 or self._frames_since_change < self.cooldown:
+            return None
+        if self.latency_ms > target and self.level < len(self.levels) - 1:
+            self.level += 1
+        elif self.latency_ms < target * self.headroom and self.level > 0:
+            self.level -= 1
+        else:
+            return None
+        
+        self._frames_since_change = 0
+        self.adjustments += 1
+        session.output_quality, session.max_inference_width, session.min_keyframe_interval = self.levels[self.level]
+        return self.decision(session)
+    
+    def decision(self, session: StreamSession) -> Dict[str, Any]:
+        """Describe the session's current level for the client"""
+        return {
+            "level": self.level,
+            "levels": len(self.levels),
+            "output_quality": session.output_quality,
+            "max_inference_width": session.max_inference_width,
+            "min_keyframe_interval": session.min_keyframe_interval,
+            "latency_ms": round(self.latency_ms, 1) if self.latency_ms is not None else None,
+            "target_latency_ms": session.target_latency_ms,
+        }
+
+def parse_resolution(value: str) -> Tuple[int, int]:
+    """Parse a WIDTHxHEIGHT setting"""
+    width, height = (int(v) for v in value.lower().split('x'))
+    return width, height
+
+def decode_background(data: Union[bytes, bytearray, memoryview], max_pixels: int = MAX_UPLOAD_PIXELS,
+                      max_resolution: Tuple[int, int] = parse_resolution(MAX_BACKGROUND_RESOLUTION)
+                      ) -> Optional[np.ndarray]:
+    """Decode an uploaded image from memory into a BGR background no larger than max_resolution"""
+    # Check the size in the header first: a small file can decode to gigabytes of pixels
+    try:
+        with Image.open(io.BytesIO(data)) as header:
+            width, height = header.size
+    except Image.DecompressionBombError as e:
+        raise ValueError(str(e))
+    except (OSError, SyntaxError):
+        return None  # Not an image Pillow can identify, so its size cannot be checked
+    if height * width > max_pixels:
+        raise ValueError(f"Image is {width}x{height}, above the {max_pixels / 1_000_000:g} megapixel limit")
+    
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        return None
+    height, width = image.shape[:2]
+    
+    # Kept in BGR like the frames it is composited with; fit long side to long side
+    scale = min(max(max_resolution) / max(width, height), min(max_resolution) / min(width, height))
+    if scale < 1:
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    return image
+
 class BackgroundReplacer:
     """Real-time background replacement using MediaPipe and OpenCV"""
     
-    def __init__(self):
+    def __init__(self, cache_bytes: int = BACKGROUND_CACHE_BYTES, pool_size: int = SEGMENTER_POOL_SIZE,
+                 inference_width: int = INFERENCE_WIDTH, mask_upsampling: str = MASK_UPSAMPLING,
+                 keyframe_interval: int = KEYFRAME_INTERVAL, scene_change_threshold: float = SCENE_CHANGE_THRESHOLD,
+                 mask_decay: float = MASK_DECAY, blur_strength: str = BLUR_STRENGTH,
+                 blur_reuse_threshold: float = BLUR_REUSE_THRESHOLD,
+                 segmentation_backend: str = SEGMENTATION_BACKEND, batch_deadline_ms: float = INFERENCE_BATCH_MS,
+                 max_batch: int = INFERENCE_MAX_BATCH):
         """Initialize the background replacer"""
-        self.mp_selfie_segmentation = mp.solutions.selfie_segmentation
-        self.selfie_segmentation = self.mp_selfie_segmentation.SelfieSegmentation(model_selection=1)
-        self.mp_drawing = mp.solutions.drawing_utils
+        if mask_upsampling not in ('bilinear', 'guided'):
+            raise ValueError(f"Unknown mask upsampling mode: {mask_upsampling}")
+        if blur_strength not in BLUR_LEVELS:
+            raise ValueError(f"Unknown blur strength: {blur_strength}")
+        self.inference_width = inference_width
+        self.mask_upsampling = mask_upsampling
+        self.keyframe_interval = max(1, keyframe_interval)
+        self.scene_change_threshold = scene_change_threshold
+        self.mask_decay = mask_decay
+        self.blur_strength = blur_strength
+        self.blur_reuse_threshold = blur_reuse_threshold
+        self.blur_reuses = 0  # Frames that reused the previous blurred background
+        
+        # Per-frame segmentation cost, split into model runs and propagated frames
+        self._segmentation_lock = threading.Lock()
+        self._keyframes = 0
+        self._keyframe_seconds = 0.0
+        self._propagated_frames = 0
+        self._propagation_seconds = 0.0
+        self.segmentation_backend = segmentation_backend
+        # A MediaPipe graph is not thread-safe, so each concurrent frame checks out its own segmenter
+        self.segmenter_pool = SegmenterPool(
+            segmenter_factory(segmentation_backend, ONNX_MODEL_PATH, ONNX_THREADS), pool_size)
+        self.inference_scheduler = (InferenceScheduler(self.segmenter_pool, batch_deadline_ms / 1000, max_batch)
+                                    if batch_deadline_ms > 0 else None)
         
-        # Background options
+        # Background options, mapped to generators taking (width, height)
         self.backgrounds = {
-            'office': self._create_office_background(),
-            'nature': self._create_nature_background(),
-            'space': self._create_space_background(),
-            'beach': self._create_beach_background(),
-            'gradient': self._create_gradient_background(),
-            'abstract': self._create_abstract_background(),
+            'office': self._create_office_background,
+            'nature': self._create_nature_background,
+            'space': self._create_space_background,
+            'beach': self._create_beach_background,
+            'gradient': self._create_gradient_background,
+            'abstract': self._create_abstract_background,
             'blur': None,  # Will be handled specially
             'none': None   # No background
         }
-        self.current_background = 'none'
+        # Whether each background mode needs a segmentation mask; custom uploads always do
+        self.mask_required = {name: name != 'none' for name in self.backgrounds}
+        self.current_background = 'none'  # Default for new sessions and session-less callers
         self.custom_backgrounds = {}  # Store custom uploaded backgrounds
+        self.custom_background_files = {}  # Custom background ID -> file on disk
+        self.custom_background_refs: Dict[str, int] = {}  # Custom background ID -> uploads sharing it
+        self._custom_load_lock = threading.Lock()  # Orders first-use loads of indexed backgrounds with releases
+        self.background_cache = BackgroundCache(cache_bytes)  # Backgrounds at stream resolutions
         
         logger.info("BackgroundReplacer initialized successfully")
     
-    def _create_office_background(self) -> np.ndarray:
+    @staticmethod
+    def _fill_rows(row_colors: np.ndarray, width: int) -> np.ndarray:
+        """Broadcast one BGR color per row across the full image width"""
+        # Casting from int wraps out-of-range values, same as the old per-row assignment
+        row_colors = row_colors.astype(np.uint8)
+        # repeat always copies; a contiguous broadcast view (width 1) would come back read-only
+        return np.repeat(row_colors[:, np.newaxis, :], width, axis=1)
+    
+    @staticmethod
+    def _pixel_grid(height: int, width: int):
+        """Return normalized (x, y) coordinate grids of shape (height, width)"""
+        y, x = np.meshgrid(np.arange(height) / height, np.arange(width) / width, indexing='ij')
+        return x, y
+    
+    def _create_office_background(self, width: int = 640, height: int = 480) -> np.ndarray:
         """Create a simple office background"""
         # Create a gradient office-like background
-        height, width = 480, 640
-        background = np.zeros((height, width, 3), dtype=np.uint8)
+        rows = np.arange(height)
         
         # Create gradient from light blue to white
-        for i in range(height):
-            intensity = int(200 + (55 * i / height))
-            background[i, :] = np.array([min(255, intensity), min(255, intensity + 20), min(255, intensity + 40)], dtype=np.uint8)
+        intensity = (200 + (55 * rows / height)).astype(np.int64)
+        row_colors = np.minimum(np.stack([intensity, intensity + 20, intensity + 40], axis=-1), 255)
         
-        return background
+        return self._fill_rows(row_colors, width)
     
-    def _create_nature_background(self) -> np.ndarray:
+    def _create_nature_background(self, width: int = 640, height: int = 480) -> np.ndarray:
         """Create a simple nature background"""
         # Create a gradient nature-like background
-        height, width = 480, 640
-        background = np.zeros((height, width, 3), dtype=np.uint8)
+        rows = np.arange(height)
+        half = height // 2
         
         # Create gradient from green to blue (sky)
-        for i in range(height):
-            if i < height // 2:  # Sky
-                intensity = int(100 + (100 * i / (height // 2)))
-                background[i, :] = np.array([min(255, intensity), min(255, intensity + 50), min(255, intensity + 100)], dtype=np.uint8)
-            else:  # Ground
-                intensity = int(50 + (50 * (i - height // 2) / (height // 2)))
-                background[i, :] = np.array([min(255, intensity), min(255, intensity + 100), min(255, intensity)], dtype=np.uint8)
+        sky = (100 + (100 * rows / half)).astype(np.int64)
+        ground = (50 + (50 * (rows - half) / half)).astype(np.int64)
+        sky_colors = np.stack([sky, sky + 50, sky + 100], axis=-1)
+        ground_colors = np.stack([ground, ground + 100, ground], axis=-1)
+        row_colors = np.where((rows < half)[:, np.newaxis], sky_colors, ground_colors)
         
-        return background
+        return self._fill_rows(np.minimum(row_colors, 255), width)
     
-    def _create_space_background(self) -> np.ndarray:
+    def _create_space_background(self, width: int = 640, height: int = 480) -> np.ndarray:
         """Create a space/cosmic background"""
-        height, width = 480, 640
-        background = np.zeros((height, width, 3), dtype=np.uint8)
+        rows = np.arange(height)
         
         # Create deep space gradient from dark blue to black
-        for i in range(height):
-            intensity = int(20 + (30 * (height - i) / height))
-            background[i, :] = np.array([intensity // 3, intensity // 2, intensity], dtype=np.uint8)
+        intensity = (20 + (30 * (height - rows) / height)).astype(np.int64)
+        background = self._fill_rows(np.stack([intensity // 3, intensity // 2, intensity], axis=-1), width)
         
-        # Add some "stars" (random bright pixels)
-        for _ in range(100):
-            x, y = np.random.randint(0, width), np.random.randint(0, height)
-            brightness = np.random.randint(150, 255)
-            background[y, x] = [brightness, brightness, brightness]
+        # Add some "stars" (random bright pixels), 100 per 640x480 of area
+        num_stars = max(1, round(100 * width * height / (640 * 480)))
+        xs = np.random.randint(0, width, size=num_stars)
+        ys = np.random.randint(0, height, size=num_stars)
+        brightness = np.random.randint(150, 255, size=num_stars).astype(np.uint8)
+        background[ys, xs] = brightness[:, np.newaxis]
         
         return background
     
-    def _create_beach_background(self) -> np.ndarray:
+    def _create_beach_background(self, width: int = 640, height: int = 480) -> np.ndarray:
         """Create a beach background"""
-        height, width = 480, 640
-        background = np.zeros((height, width, 3), dtype=np.uint8)
+        rows = np.arange(height)
+        half, quarter = height // 2, height // 4
         
         # Sky (top half)
-        for i in range(height // 2):
-            intensity = int(100 + (80 * i / (height // 2)))
-            background[i, :] = np.array([intensity, intensity + 50, intensity + 100], dtype=np.uint8)
+        sky = (100 + (80 * rows / half)).astype(np.int64)
+        sky_colors = np.stack([sky, sky + 50, sky + 100], axis=-1)
         
         # Water (middle section)
-        for i in range(height // 2, height * 3 // 4):
-            intensity = int(50 + (30 * (i - height // 2) / (height // 4)))
-            background[i, :] = np.array([intensity + 50, intensity + 80, intensity + 120], dtype=np.uint8)
+        water = (50 + (30 * (rows - half) / quarter)).astype(np.int64)
+        water_colors = np.stack([water + 50, water + 80, water + 120], axis=-1)
         
         # Sand (bottom section)
-        for i in range(height * 3 // 4, height):
-            intensity = int(80 + (40 * (i - height * 3 // 4) / (height // 4)))
-            background[i, :] = np.array([intensity + 60, intensity + 40, intensity], dtype=np.uint8)
+        sand = (80 + (40 * (rows - height * 3 // 4) / quarter)).astype(np.int64)
+        sand_colors = np.stack([sand + 60, sand + 40, sand], axis=-1)
         
-        return background
+        row_colors = np.where((rows < half)[:, np.newaxis], sky_colors,
+                              np.where((rows < height * 3 // 4)[:, np.newaxis], water_colors, sand_colors))
+        
+        return self._fill_rows(row_colors, width)
     
-    def _create_gradient_background(self) -> np.ndarray:
+    def _create_gradient_background(self, width: int = 640, height: int = 480) -> np.ndarray:
         """Create a colorful gradient background"""
-        height, width = 480, 640
-        background = np.zeros((height, width, 3), dtype=np.uint8)
+        x, y = self._pixel_grid(height, width)
         
         # Create a diagonal gradient from purple to pink
-        for i in range(height):
-            for j in range(width):
-                # Normalize coordinates
-                x = j / width
-                y = i / height
-                
-                # Create gradient from purple to pink
-                r = int(128 + 127 * (x + y) / 2)
-                g = int(50 + 100 * x)
-                b = int(200 - 100 * y)
-                
-                background[i, j] = [min(255, max(0, b)), min(255, max(0, g)), min(255, max(0, r))]
+        r = (128 + 127 * (x + y) / 2).astype(np.int64)
+        g = (50 + 100 * x).astype(np.int64)
+        b = (200 - 100 * y).astype(np.int64)
         
-        return background
+        return np.clip(np.stack([b, g, r], axis=-1), 0, 255).astype(np.uint8)
     
-    def _create_abstract_background(self) -> np.ndarray:
+    def _create_abstract_background(self, width: int = 640, height: int = 480) -> np.ndarray:
         """Create an abstract artistic background"""
-        height, width = 480, 640
-        background = np.zeros((height, width, 3), dtype=np.uint8)
-        
-        # Create multiple overlapping gradients
-        for i in range(height):
-            for j in range(width):
-                x = j / width
-                y = i / height
-                
-                # Multiple sine waves for abstract effect
-                r = int(100 + 100 * np.sin(x * np.pi * 2) * np.cos(y * np.pi * 2))
-                g = int(100 + 100 * np.sin(y * np.pi * 3) * np.cos(x * np.pi * 1.5))
-                b = int(100 + 100 * np.sin((x + y) * np.pi * 2.5))
-                
-                background[i, j] = [min(255, max(0, b)), min(255, max(0, g)), min(255, max(0, r))]
+        x, y = self._pixel_grid(height, width)
         
-        return background
+        # Multiple sine waves for abstract effect
+        r = (100 + 100 * np.sin(x * np.pi * 2) * np.cos(y * np.pi * 2)).astype(np.int64)
+        g = (100 + 100 * np.sin(y * np.pi * 3) * np.cos(x * np.pi * 1.5)).astype(np.int64)
+        b = (100 + 100 * np.sin((x + y) * np.pi * 2.5)).astype(np.int64)
+        
+        return np.clip(np.stack([b, g, r], axis=-1), 0, 255).astype(np.uint8)
+    
+    def get_predefined_background(self, background_type: str, width: int, height: int) -> Optional[np.ndarray]:
+        """Get a predefined background rendered natively at the given frame size"""
+        generator = self.backgrounds.get(background_type)
+        if generator is None:
+            return None
+        
+        def render() -> np.ndarray:
+            # Render on first use for this resolution, then reuse for every frame
+            logger.info(f"Rendering {background_type} background at {width}x{height}")
+            return generator(width, height)
+        
+        return self.background_cache.get(background_type, height, width, np.uint8, render)
+    
+    def get_custom_background(self, background_id: str, width: int, height: int) -> Optional[np.ndarray]:
+        """Get a custom background resized once to the given frame size"""
+        source = self.custom_backgrounds.get(background_id)
+        file_path = self.custom_background_files.get(background_id)
+        if source is None and file_path is not None:
+            # Registered from the index without pixels: decode it now, outside the lock so a
+            # release never waits for a decode
+            image = self._read_custom_background(background_id, file_path)
+            with self._custom_load_lock:
+                source = self.custom_backgrounds.get(background_id)
+                # Keep it only if it was not released (and its file deleted) while decoding
+                if source is None and image is not None and self.custom_background_files.get(background_id) == file_path:
+                    self.custom_backgrounds[background_id] = source = image
+                    logger.info(f"Custom background loaded: {background_id}")
+        if source is None:
+            return None
+        return self.background_cache.get(background_id, height, width, source.dtype,
+                                         lambda: self._resize_background(source, width, height))
+    
+    @staticmethod
+    def _resize_background(source: np.ndarray, width: int, height: int) -> np.ndarray:
+        """Resize a custom background to a frame size"""
+        if source.shape[:2] == (height, width):
+            return source
+        shrinking = width * height < source.shape[0] * source.shape[1]
+        return cv2.resize(source, (width, height), interpolation=cv2.INTER_AREA if shrinking else cv2.INTER_LINEAR)
+    
+    def prerender_custom_background(self, background_id: str,
+                                    resolutions: str = PRERENDER_RESOLUTIONS) -> int:
+        """Resize a new custom background for common stream resolutions into the cache's spare room
+        
+        Pre-rendered sizes go in at the cold end and never evict anything, so uploads cannot push
+        out backgrounds that live streams are using. Returns how many sizes were cached.
+        """
+        source = self.custom_backgrounds.get(background_id)
+        if source is None:
+            return 0
+        prerendered = 0
+        for resolution in filter(None, resolutions.split(',')):
+            width, height = parse_resolution(resolution)
+            prerendered += self.background_cache.prefill(
+                background_id, height, width, source.dtype, height * width * source.shape[2] * source.itemsize,
+                lambda: self._resize_background(source, width, height))
+        return prerendered
     
     def add_custom_background(self, background_id: str, background_image: np.ndarray) -> bool:
         """Add a custom background image"""
         try:
             self.custom_backgrounds[background_id] = background_image
+            self.custom_background_refs.setdefault(background_id, 1)
+            self.background_cache.invalidate(background_id)
             logger.info(f"Custom background added: {background_id}")
             return True
         except Exception as e:
             logger.error(f"Error adding custom background: {e}")
             return False
     
-    def set_background(self, background_type: str) -> bool:
-        """Set the background type"""
+    def register_custom_background(self, background_id: str, file_path: str, references: int = 1) -> None:
+        """Make a stored custom background available without decoding it until a stream uses it"""
+        self.custom_background_files[background_id] = file_path
+        self.custom_background_refs[background_id] = references
+    
+    def has_custom_background(self, background_id: str) -> bool:
+        """Check whether a custom background is loaded or registered"""
+        return background_id in self.custom_backgrounds or background_id in self.custom_background_files
+    
+    def retain_custom_background(self, background_id: str) -> bool:
+        """Count another upload of an existing custom background; False if there is none"""
+        if not self.has_custom_background(background_id):
+            return False
+        self.custom_background_refs[background_id] = self.custom_background_refs.get(background_id, 0) + 1
+        return True
+    
+    def release_custom_background(self, background_id: str) -> Optional[str]:
+        """Drop one reference to a custom background and return its file once nothing uses it"""
+        with self._custom_load_lock:
+            refs = self.custom_background_refs.get(background_id, 0) - 1
+            if refs > 0:
+                self.custom_background_refs[background_id] = refs
+                return None
+            
+            self.custom_background_refs.pop(background_id, None)
+            self.custom_backgrounds.pop(background_id, None)
+            file_path = self.custom_background_files.pop(background_id, None)
+        self.background_cache.invalidate(background_id)
+        if self.current_background == background_id:
+            self.current_background = 'none'
+        logger.info(f"Custom background removed: {background_id}")
+        return file_path
+    
+    def custom_background_stats(self) -> Dict[str, Any]:
+        """Return custom background counts and the memory saved by sharing identical uploads"""
+        images = self.custom_backgrounds
+        known = images.keys() | self.custom_background_files.keys()
+        return {
+            "backgrounds": len(known),
+            "loaded": len(images),
+            "uploads": sum(self.custom_background_refs.get(background_id, 1) for background_id in known),
+            "bytes": sum(image.nbytes for image in images.values()),
+            "deduplicated_bytes": sum((self.custom_background_refs.get(background_id, 1) - 1) * image.nbytes
+                                      for background_id, image in images.items()),
+        }
+    
+    @staticmethod
+    def _read_custom_background(background_id: str, file_path: str) -> Optional[np.ndarray]:
+        """Decode a stored custom background, or return None if it cannot be read"""
+        try:
+            with open(file_path, "rb") as source:
+                return decode_background(source.read(), max_pixels=sys.maxsize)
+        except (OSError, ValueError) as e:
+            logger.error(f"Error loading custom background {background_id}: {e}")
+            return None
+    
+    def load_custom_background(self, background_id: str, file_path: str) -> bool:
+        """Load a custom background image from disk"""
+        image = self._read_custom_background(background_id, file_path)
+        if image is None:
+            return False
+        
+        self.custom_background_files[background_id] = file_path
+        return self.add_custom_background(background_id, image)
+    
+    def has_background(self, background_type: str) -> bool:
+        """Check whether a predefined or custom background exists"""
+        return background_type in self.backgrounds or self.has_custom_background(background_type)
+    
+    def requires_mask(self, background_type: str) -> bool:
+        """Check whether a background mode needs segmentation, or can pass frames through untouched"""
+        return self.mask_required.get(background_type, True)
+    
+    def set_background(self, background_type: str, session: Optional[StreamSession] = None) -> bool:
+        """Set the background type for a session, or the default when no session is given"""
         logger.info(f"Attempting to set background to: {background_type}")
         logger.info(f"Available predefined backgrounds: {list(self.backgrounds.keys())}")
         logger.info(f"Available custom backgrounds: {list(self.custom_backgrounds.keys())}")
         
-        if background_type in self.backgrounds or background_type in self.custom_backgrounds:
-            self.current_background = background_type
+        if self.has_background(background_type):
+            if session is not None:
+                session.background = background_type
+            else:
+                self.current_background = background_type
             logger.info(f"Background successfully changed to: {background_type}")
             return True
         else:
             logger.warning(f"Background type '{background_type}' not found in available backgrounds")
             return False
     
-    def process_frame(self, frame: np.ndarray) -> np.ndarray:
+    @staticmethod
+    def _buffer(state: Optional[Dict[str, Any]], name: str, shape: Tuple[int, ...], dtype: Any) -> np.ndarray:
+        """Return a session's reusable buffer, or a fresh array for session-less callers"""
+        if state is None:
+            return np.empty(shape, dtype=dtype)
+        buffer = state.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            state[name] = buffer
+        return buffer
+    
+    @staticmethod
+    def composite(frame: np.ndarray, mask: np.ndarray, background: np.ndarray, out: np.ndarray) -> np.ndarray:
+        """Copy frame over background wherever the single-channel mask is set, writing into out"""
+        np.copyto(out, background)
+        cv2.copyTo(frame, mask, out)
+        return out
+    
+    @staticmethod
+    def composite_soft(frame: np.ndarray, alpha: np.ndarray, background: np.ndarray, out: np.ndarray) -> np.ndarray:
+        """Blend frame over background with a 0-256 uint16 alpha in 8.8 fixed point, writing into out"""
+        # Wherever alpha is only 0 or 256 the binary copy is already exact
+        np.copyto(out, background)
+        cv2.copyTo(frame, cv2.compare(alpha, 128, cv2.CMP_GT), out)
+        
+        # Blend only the tiles the soft edge passes through
+        height, width = alpha.shape
+        partial = cv2.inRange(alpha, 1, 255)
+        tiles = np.maximum.reduceat(np.maximum.reduceat(partial, np.arange(0, height, BLEND_TILE), axis=0),
+                                    np.arange(0, width, BLEND_TILE), axis=1)
+        for row, column in zip(*np.nonzero(tiles)):
+            y, x = row * BLEND_TILE, column * BLEND_TILE
+            tile = np.s_[y:y + BLEND_TILE, x:x + BLEND_TILE]
+            weight = alpha[tile]
+            foreground = cv2.multiply(frame[tile].astype(np.uint16), cv2.merge((weight,) * 3))
+            weight = 256 - weight
+            blended = cv2.add(foreground, cv2.multiply(background[tile].astype(np.uint16), cv2.merge((weight,) * 3)))
+            out[tile] = cv2.convertScaleAbs(blended, alpha=1 / 256)
+        return out
+    
+    def blur_background(self, frame: np.ndarray, session: Optional[StreamSession] = None) -> np.ndarray:
+        """Blur a frame cheaply: pyrDown, blur at low resolution, upsample once"""
+        state = session.state if session is not None else None
+        strength = self.blur_strength
+        if session is not None and session.blur_strength is not None:
+            strength = session.blur_strength
+        levels, ksize = BLUR_LEVELS[strength]
+        height, width = frame.shape[:2]
+        levels += max(0, round(math.log2(width / 640)))
+        
+        small = frame
+        for _ in range(levels):
+            small = cv2.pyrDown(small)
+        
+        # A static camera gives (nearly) the same blurred background as last frame
+        blurred = state.get('blur') if state is not None else None
+        reference = state.get('blur_reference') if state is not None else None
+        if (self.blur_reuse_threshold > 0 and blurred is not None and blurred.shape == frame.shape
+                and reference is not None and reference.shape == small.shape
+                and cv2.norm(small, reference, cv2.NORM_L1) / small.size < self.blur_reuse_threshold):
+            self.blur_reuses += 1
+            return blurred
+        if state is not None:
+            state['blur_reference'] = small
+        
+        small = cv2.GaussianBlur(small, (ksize, ksize), 0)
+        return cv2.resize(small, (width, height), interpolation=cv2.INTER_LINEAR,
+                          dst=self._buffer(state, 'blur', frame.shape, np.uint8))
+    
+    @staticmethod
+    def _edge_settings(session: Optional[StreamSession]) -> Tuple[str, int]:
+        """Return the session's edge mode and edgeSmoothing (0-100) from its client settings"""
+        if session is None:
+            return 'binary', 0
+        mode = QUALITY_EDGE_MODES.get(session.settings.get('quality'), 'binary')
+        try:
+            edge_smoothing = min(max(int(session.settings.get('edgeSmoothing', 0)), 0), 100)
+        except (TypeError, ValueError):
+            edge_smoothing = 0
+        return mode, edge_smoothing
+    
+    @staticmethod
+    def _refine_edges(mask: np.ndarray, small_frame: np.ndarray, mode: str, edge_smoothing: int) -> np.ndarray:
+        """Feather or guided-filter an inference-resolution mask; the radius follows edgeSmoothing"""
+        radius = max(1, round(edge_smoothing / 100 * MAX_EDGE_RADIUS * mask.shape[1] / 640))
+        if mode == 'guided':
+            return guided_filter(mask, small_frame, radius)
+        return cv2.GaussianBlur(mask, (2 * radius + 1, 2 * radius + 1), 0)
+    
+    def inference_settings(self, session: Optional[StreamSession], width: int) -> Tuple[int, int]:
+        """Return the inference width and keyframe interval for a session's frames of the given width"""
+        inference_width = self.inference_width
+        keyframe_interval = self.keyframe_interval
+        if session is None:
+            return inference_width, keyframe_interval
+        
+        if session.inference_width is not None:
+            inference_width = session.inference_width
+        if session.keyframe_interval is not None:
+            keyframe_interval = session.keyframe_interval
+        # The quality controller only ever lowers resolution and raises the interval
+        if session.max_inference_width is not None:
+            inference_width = min(inference_width if 0 < inference_width < width else width,
+                                  session.max_inference_width)
+        if session.min_keyframe_interval is not None:
+            keyframe_interval = max(keyframe_interval, session.min_keyframe_interval)
+        return inference_width, keyframe_interval
+    
+    def segment(self, frame: np.ndarray, session: Optional[StreamSession] = None) -> Optional[np.ndarray]:
+        """Run segmentation at inference resolution and return a float person mask at frame size"""
+        state = session.state if session is not None else None
+        height, width = frame.shape[:2]
+        inference_width, keyframe_interval = self.inference_settings(session, width)
+        
+        # Downscale once; color conversion and inference then run on the small image
+        if 0 < inference_width < width:
+            size = (inference_width, max(1, round(height * inference_width / width)))
+            small_frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA,
+                                     dst=self._buffer(state, 'small', (size[1], size[0], 3), np.uint8))
+        else:
+            small_frame = frame
+        
+        start = time.perf_counter()
+        if state is not None and keyframe_interval > 1:
+            segmentation_mask, keyframe = self._temporal_mask(small_frame, state, keyframe_interval)
+        else:
+            segmentation_mask, keyframe = self._infer(small_frame, state), True
+        elapsed = time.perf_counter() - start
+        with self._segmentation_lock:
+            if keyframe:
+                self._keyframes += 1
+                self._keyframe_seconds += elapsed
+            else:
+                self._propagated_frames += 1
+                self._propagation_seconds += elapsed
+        
+        if segmentation_mask is None:
+            return None
+        
+        # Smooth at inference resolution, before the mask is upsampled
+        segmentation_mask = self._smooth_mask(segmentation_mask, session)
+        edge_mode, edge_smoothing = self._edge_settings(session)
+        if edge_mode != 'binary' and edge_smoothing > 0:
+            segmentation_mask = self._refine_edges(segmentation_mask, small_frame, edge_mode, edge_smoothing)
+        if segmentation_mask.shape[:2] == (height, width):
+            return segmentation_mask
+        
+        # Upsample only the mask back to full size
+        if self.mask_upsampling == 'guided':
+            return guided_upsample(segmentation_mask, small_frame, frame)
+        return cv2.resize(segmentation_mask, (width, height), interpolation=cv2.INTER_LINEAR,
+                          dst=self._buffer(state, 'mask_full', (height, width), np.float32))
+    
+    def _infer(self, small_frame: np.ndarray, state: Optional[Dict[str, Any]]) -> Optional[np.ndarray]:
+        """Run the segmentation model on an inference-size BGR frame"""
+        # Convert BGR to RGB for MediaPipe
+        rgb_frame = cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB,
+                                 dst=self._buffer(state, 'rgb', small_frame.shape, np.uint8))
+        
+        # Get segmentation mask, batched with other sessions' frames if enabled
+        if self.inference_scheduler is not None:
+            return self.inference_scheduler.process(rgb_frame)
+        with self.segmenter_pool.checkout() as segmenter:
+            return segmenter.process([rgb_frame])[0]
+    
+    def _temporal_mask(self, small_frame: np.ndarray, state: Dict[str, Any],
+                       keyframe_interval: int) -> Tuple[Optional[np.ndarray], bool]:
+        """Run the model on keyframes and propagate the last mask with optical flow in between"""
+        guide = flow_guide(small_frame)
+        previous_guide = state.get('flow_guide')
+        last_mask = state.get('last_mask')
+        state['flow_guide'] = guide
+        
+        keyframe = (last_mask is None or previous_guide.shape != guide.shape
+                    or state['frames_since_keyframe'] + 1 >= keyframe_interval
+                    or cv2.norm(guide, previous_guide, cv2.NORM_L1) / guide.size > self.scene_change_threshold)
+        if keyframe:
+            mask = self._infer(small_frame, state)
+            # Propagate at flow resolution; the model's own output is no finer than that
+            state['last_mask'] = (cv2.resize(mask, guide.shape[::-1], interpolation=cv2.INTER_AREA)
+                                  if mask is not None else None)
+            state['frames_since_keyframe'] = 0
+            return mask, True
+        
+        state['last_mask'] = propagate_mask(last_mask, previous_guide, guide)
+        state['frames_since_keyframe'] += 1
+        height, width = small_frame.shape[:2]
+        mask = cv2.resize(state['last_mask'], (width, height), interpolation=cv2.INTER_LINEAR,
+                          dst=self._buffer(state, 'propagated_mask', (height, width), np.float32))
+        return mask, False
+    
+    def _smooth_mask(self, mask: np.ndarray, session: Optional[StreamSession]) -> np.ndarray:
+        """Blend the mask into the session's running average to suppress flicker at the silhouette
+
+        The average persists between frames as float16; it is widened into the session's
+        float32 working buffer, updated in place with accumulateWeighted and narrowed back.
+        """
+        decay = self.mask_decay
+        if session is not None and session.mask_decay is not None:
+            decay = session.mask_decay
+        if session is None or decay <= 0:
+            return mask
+        
+        state = session.state
+        shape = mask.shape[:2]
+        smoothed = self._buffer(state, 'mask_smoothed', shape, np.float32)
+        average = state.get('mask_average')
+        if average is None or average.shape != shape:
+            average = state['mask_average'] = np.empty(shape, dtype=np.float16)
+            np.copyto(smoothed, mask)
+        else:
+            # numpy's float16 arithmetic is scalar; OpenCV converts with SIMD
+            cv2.convertFp16(average.view(np.int16), smoothed)
+            cv2.accumulateWeighted(mask, smoothed, 1.0 - decay)
+        cv2.convertFp16(smoothed, average.view(np.int16))
+        return smoothed
+    
+    def segmentation_stats(self) -> Dict[str, Any]:
+        """Return keyframe/propagation counts and their average cost per frame"""
+        with self._segmentation_lock:
+            frames = self._keyframes + self._propagated_frames
+            return {
+                "backend": self.segmentation_backend,
+                "keyframe_interval": self.keyframe_interval,
+                "keyframes": self._keyframes,
+                "propagated_frames": self._propagated_frames,
+                "keyframe_ms": 1000 * self._keyframe_seconds / self._keyframes if self._keyframes else 0.0,
+                "propagated_ms": (1000 * self._propagation_seconds / self._propagated_frames
+                                  if self._propagated_frames else 0.0),
+                "per_frame_ms": (1000 * (self._keyframe_seconds + self._propagation_seconds) / frames
+                                 if frames else 0.0),
+            }
+    
+    def stats(self) -> Dict[str, Any]:
+        """Return the counters of the caches, models and segmentation this replacer runs"""
+        return {
+            "background_cache": self.background_cache.stats(),
+            "segmenter_pool": self.segmenter_pool.stats(),
+            "segmentation": self.segmentation_stats(),
+            "inference_scheduler": self.inference_scheduler.stats() if self.inference_scheduler else None,
+            "blur_reuses": self.blur_reuses,
+        }
+    
+    def process_frame(self, frame: np.ndarray, session: Optional[StreamSession] = None) -> np.ndarray:
         """Process a single frame and replace background"""
+        background_type = session.background if session is not None else self.current_background
+        if not self.requires_mask(background_type):
+            # Pass-through: no color conversion or inference
+            return frame
+        
+        # Sessions process one frame at a time, so their buffers are reused frame to frame
+        state = session.state if session is not None else None
         try:
-            # Convert BGR to RGB for MediaPipe
-            rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            
-            # Get segmentation mask
-            results = self.selfie_segmentation.process(rgb_frame)
+            segmentation_mask = self.segment(frame, session)
             
-            if results.segmentation_mask is not None:
-                # Create 3-channel mask
-                mask = np.stack((results.segmentation_mask,) * 3, axis=-1)
-                mask = (mask > 0.5).astype(np.uint8)
-                
-                # Resize frame to match mask if needed
-                if frame.shape[:2] != mask.shape[:2]:
-                    frame = cv2.resize(frame, (mask.shape[1], mask.shape[0]))
-                
+            if segmentation_mask is not None:
                 # Apply background
-                if self.current_background == 'blur':
+                if background_type == 'blur':
                     # Create blurred background
-                    background = cv2.GaussianBlur(frame, (21, 21), 0)
-                elif self.current_background == 'none':
-                    # No background change
-                    return frame
-                elif self.current_background in self.backgrounds:
-                    # Use predefined background
-                    background = self.backgrounds[self.current_background]
-                    if background.shape[:2] != frame.shape[:2]:
-                        background = cv2.resize(background, (frame.shape[1], frame.shape[0]))
-                elif self.current_background in self.custom_backgrounds:
-                    # Use custom background
-                    background = self.custom_backgrounds[self.current_background]
-                    if background.shape[:2] != frame.shape[:2]:
-                        background = cv2.resize(background, (frame.shape[1], frame.shape[0]))
+                    background = self.blur_background(frame, session)
+                elif background_type in self.backgrounds:
+                    # Use predefined background, rendered at the frame's native size
+                    background = self.get_predefined_background(background_type, frame.shape[1], frame.shape[0])
+                elif self.has_custom_background(background_type):
+                    # Use custom background, resized once per resolution
+                    background = self.get_custom_background(background_type, frame.shape[1], frame.shape[0])
+                    if background is None:
+                        return frame
                 else:
                     # Default to original frame
                     return frame
                 
+                output = self._buffer(state, 'output', frame.shape, np.uint8)
+                if self._edge_settings(session)[0] != 'binary':
+                    # Soft alpha, 0-256 so that full coverage needs no rounding
+                    alpha = np.multiply(segmentation_mask, 256, casting='unsafe',
+                                        out=self._buffer(state, 'alpha', frame.shape[:2], np.uint16))
+                    return self.composite_soft(frame, alpha, background, output)
+                
+                # Single-channel 0/255 person mask
+                mask = cv2.compare(segmentation_mask, 0.5, cv2.CMP_GT,
+                                   dst=self._buffer(state, 'mask', frame.shape[:2], np.uint8))
+                
                 # Combine foreground and background
-                result = frame * mask + background * (1 - mask)
-                return result.astype(np.uint8)
+                return self.composite(frame, mask, background, output)
             else:
                 return frame
                 
@@ -233,6 +1009,436 @@ class BackgroundReplacer:
             logger.error(f"Error processing frame: {e}")
             return frame
 
+class PendingFrame(NamedTuple):
+    """A received frame waiting to be processed"""
+    payload: Union[str, bytes, memoryview]  # base64 string (JSON mode) or raw image bytes (binary mode)
+    codec: str
+    header: Optional[FrameHeader]  # Set for binary frames, echoed in the reply
+    timestamp: Optional[float] = None  # Client send time in ms, from the header or the JSON message
+    received: float = 0.0  # Server receive time (time.time())
+
+class FrameMailbox:
+    """Per-connection frame slots where newer frames push out stale ones before inference"""
+    
+    def __init__(self, slots: int = FRAME_MAILBOX_SLOTS):
+        """Create a mailbox holding at most slots frames"""
+        self.slots = max(1, slots)
+        self.received = 0
+        self.dropped = 0
+        self._frames: "deque[PendingFrame]" = deque(maxlen=self.slots)
+        self._ready = asyncio.Event()
+    
+    def put(self, frame: PendingFrame) -> None:
+        """Add a frame, dropping the oldest waiting frame if the mailbox is full"""
+        if len(self._frames) == self.slots:
+            self.dropped += 1
+        self._frames.append(frame)
+        self.received += 1
+        self._ready.set()
+    
+    async def get(self) -> PendingFrame:
+        """Wait for and remove the oldest waiting frame"""
+        while not self._frames:
+            self._ready.clear()
+            await self._ready.wait()
+        return self._frames.popleft()
+
+class StreamAdmission:
+    """Concurrent-stream limit for /ws with a FIFO wait queue or immediate rejection when full"""
+    
+    def __init__(self, max_streams: int = MAX_STREAMS, policy: str = ADMISSION_POLICY,
+                 queue_timeout: float = ADMISSION_TIMEOUT):
+        """Admit up to max_streams streams (0 = unlimited); policy is queue or reject"""
+        if policy not in ('queue', 'reject'):
+            raise ValueError(f"Unknown admission policy: {policy}")
+        
+        self.max_streams = max(0, max_streams)
+        self.policy = policy
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.queued = 0
+        self._waiters: "deque[asyncio.Future]" = deque()
+        self._queue_seconds = 0.0
+        self._max_queue_seconds = 0.0
+    
+    def has_capacity(self) -> bool:
+        """Check whether a new stream would be admitted without waiting"""
+        return not self.max_streams or (self.active < self.max_streams and not self._waiters)
+    
+    @property
+    def waiting(self) -> int:
+        """Connections currently queued for a stream"""
+        return sum(not waiter.done() for waiter in self._waiters)
+    
+    async def admit(self) -> bool:
+        """Take a stream, waiting in line under the queue policy; False if the connection is turned away"""
+        if self.has_capacity():
+            self.active += 1
+            self.admitted += 1
+            return True
+        if self.policy == 'reject':
+            self.rejected += 1
+            return False
+        
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.queued += 1
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if not waiter.done():
+                waiter.cancel()
+                self.timed_out += 1
+                self.rejected += 1
+                return False
+        except asyncio.CancelledError:
+            # The stream may have been handed over just before the connection went away
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            else:
+                waiter.cancel()
+            raise
+        
+        # release() handed its stream to this waiter, so active is unchanged
+        waited = time.perf_counter() - start
+        self._queue_seconds += waited
+        self._max_queue_seconds = max(self._max_queue_seconds, waited)
+        self.admitted += 1
+        return True
+    
+    def release(self) -> None:
+        """Return a stream, handing it straight to the longest-waiting connection if any"""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active = max(0, self.active - 1)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Return admission settings and counters for monitoring"""
+        waited = self.queued - self.timed_out
+        return {
+            "max_streams": self.max_streams,
+            "policy": self.policy,
+            "active": self.active,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "queued": self.queued,
+            "avg_queue_ms": self._queue_seconds / waited * 1000 if waited else 0.0,
+            "max_queue_ms": self._max_queue_seconds * 1000,
+        }
+
+class FairFrameScheduler:
+    """Frame slots shared weighted-fairly between sessions by the processing time they have used
+    
+    Each session's virtual time advances by the seconds its frames take, and a free slot goes to
+    the waiting session with the smallest virtual time, so a session sending large frames at a
+    high rate gets the same share of processing time as one sending small ones.
+    """
+    
+    def __init__(self, slots: int):
+        """Allow slots frames to be processed or queued in the pool at once"""
+        self.slots = max(1, slots)
+        self.busy = 0
+        self.frames = 0
+        self.waited_frames = 0
+        self._clock = 0.0  # Virtual time of the most recently started frame
+        self._virtual_times: Dict[str, float] = {}
+        self._waiters: List[Tuple[float, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self._wait_seconds = 0.0
+        self._max_wait_seconds = 0.0
+    
+    @asynccontextmanager
+    async def slot(self, session_id: str) -> AsyncIterator[None]:
+        """Hold a frame slot for session_id while the with-block runs"""
+        # Sessions that were idle start at the current virtual time rather than banking credit
+        virtual_time = max(self._virtual_times.get(session_id, 0.0), self._clock)
+        if self.busy < self.slots and not self._waiters:
+            self.busy += 1
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiters, (virtual_time, next(self._sequence), waiter))
+            start = time.perf_counter()
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self._release()  # Handed a slot just as the session went away
+                else:
+                    waiter.cancel()
+                raise
+            waited = time.perf_counter() - start
+            self.waited_frames += 1
+            self._wait_seconds += waited
+            self._max_wait_seconds = max(self._max_wait_seconds, waited)
+        
+        self._clock = max(self._clock, virtual_time)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.frames += 1
+            self._virtual_times[session_id] = virtual_time + (time.perf_counter() - start)
+            self._release()
+    
+    def _release(self) -> None:
+        """Hand a finished slot to the waiting session that has used the least time"""
+        while self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.busy -= 1
+    
+    def forget(self, session_id: str) -> None:
+        """Drop a finished session's virtual time"""
+        self._virtual_times.pop(session_id, None)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Return slot usage and wait times for monitoring"""
+        return {
+            "slots": self.slots,
+            "busy": self.busy,
+            "waiting": sum(not waiter.done() for _, _, waiter in self._waiters),
+            "frames": self.frames,
+            "waited_frames": self.waited_frames,
+            "avg_wait_ms": self._wait_seconds / self.waited_frames * 1000 if self.waited_frames else 0.0,
+            "max_wait_ms": self._max_wait_seconds * 1000,
+        }
+
+def encode_params(codec: str, session: Optional[StreamSession]) -> list:
+    """imencode parameters for the session's output quality"""
+    if session is None or session.output_quality is None:
+        return []
+    flag = cv2.IMWRITE_JPEG_QUALITY if codec == 'jpeg' else cv2.IMWRITE_WEBP_QUALITY
+    return [flag, session.output_quality]
+
+def process_encoded_frame(replacer: BackgroundReplacer, image_bytes: bytes, codec: str = 'jpeg',
+                          session: Optional[StreamSession] = None) -> Optional[bytes]:
+    """Decode a compressed frame, replace its background and re-encode it with the given codec"""
+    nparr = np.frombuffer(image_bytes, np.uint8)
+    frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    if frame is None:
+        return None
+    
+    processed_frame = replacer.process_frame(frame, session)
+    _, buffer = cv2.imencode(CODEC_EXTENSIONS[codec], processed_frame, encode_params(codec, session))
+    return buffer.tobytes()
+
+def process_frame_payload(replacer: BackgroundReplacer, payload: Union[str, bytes], codec: str = 'jpeg',
+                          session: Optional[StreamSession] = None) -> Optional[Union[str, bytes]]:
+    """Process a raw (binary mode) or base64 (JSON mode) frame and return the result in the same form"""
+    if isinstance(payload, str):
+        processed = process_encoded_frame(replacer, base64.b64decode(payload), codec, session)
+        return None if processed is None else base64.b64encode(processed).decode('utf-8')
+    return process_encoded_frame(replacer, payload, codec, session)
+
+def _prepare_worker_session(replacer: BackgroundReplacer, session: StreamSession, background_file: Optional[str]) -> None:
+    """Make a session's background available to a pool process's own replacer"""
+    if not replacer.has_background(session.background):
+        # Custom uploads live in the server process; load them from disk on first use
+        if not background_file or not replacer.load_custom_background(session.background, background_file):
+            session.background = 'none'
+
+# Runtime state of the sessions pinned to this pool process, keyed by session ID
+_worker_session_states: Dict[str, Dict[str, Any]] = {}
+
+def _process_frame_in_worker(payload: Union[str, bytes], codec: str, session: StreamSession,
+                             background_file: Optional[str]) -> Optional[Union[str, bytes]]:
+    """Process a frame inside a pool process, using that process's own replacer"""
+    replacer = background_replacer
+    # Sessions arrive with fresh settings but no runtime buffers; reattach the ones kept here
+    session.state = _worker_session_states.setdefault(session.session_id, {})
+    _prepare_worker_session(replacer, session, background_file)
+    return process_frame_payload(replacer, payload, codec, session)
+
+def _close_worker_session(session_id: str) -> None:
+    """Drop a finished session's runtime state in a pool process"""
+    _worker_session_states.pop(session_id, None)
+
+def _worker_replacer_stats() -> Dict[str, Any]:
+    """Return a pool process's own replacer counters"""
+    return background_replacer.stats()
+
+def combine_segmentation_stats(stats: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Add up segmentation_stats() from several replacers, weighting the averages by frame counts"""
+    keyframes = sum(entry["keyframes"] for entry in stats)
+    propagated_frames = sum(entry["propagated_frames"] for entry in stats)
+    keyframe_ms = sum(entry["keyframe_ms"] * entry["keyframes"] for entry in stats)
+    propagated_ms = sum(entry["propagated_ms"] * entry["propagated_frames"] for entry in stats)
+    frames = keyframes + propagated_frames
+    return {
+        "backend": stats[0]["backend"] if stats else None,
+        "keyframe_interval": stats[0]["keyframe_interval"] if stats else None,
+        "keyframes": keyframes,
+        "propagated_frames": propagated_frames,
+        "keyframe_ms": keyframe_ms / keyframes if keyframes else 0.0,
+        "propagated_ms": propagated_ms / propagated_frames if propagated_frames else 0.0,
+        "per_frame_ms": (keyframe_ms + propagated_ms) / frames if frames else 0.0,
+    }
+
+def _process_shared_frame_in_worker(replacer: BackgroundReplacer, frame: np.ndarray, session: StreamSession,
+                                    background_file: Optional[str]) -> np.ndarray:
+    """Composite a decoded frame handed over through shared memory (runs in a worker process)"""
+    _prepare_worker_session(replacer, session, background_file)
+    return replacer.process_frame(frame, session)
+
+class FrameExecutor:
+    """Bounded pool that keeps CPU-bound frame processing off the event loop"""
+    
+    def __init__(self, replacer: BackgroundReplacer, mode: str = FRAME_EXECUTOR, max_workers: int = FRAME_WORKERS):
+        """Create a thread, process or shared-memory worker pool with max_workers workers"""
+        if mode not in ('thread', 'process', 'shared_memory'):
+            raise ValueError(f"Unknown frame executor mode: {mode}")
+        
+        self.replacer = replacer
+        self.mode = mode
+        self.max_workers = max_workers
+        self.oversized_frames = 0  # Frames too large for a shared-memory slot, processed in-thread
+        self._worker_pool: Optional[SharedMemoryWorkerPool] = None
+        self._process_executors: List[ProcessPoolExecutor] = []
+        if mode == 'process':
+            # One single-process pool per worker so each session sticks to the process holding its state;
+            # spawn rather than fork: MediaPipe's graph threads do not survive a fork
+            context = multiprocessing.get_context('spawn')
+            self._process_executors = [ProcessPoolExecutor(max_workers=1, mp_context=context)
+                                       for _ in range(max_workers)]
+            self._executor = None
+        elif mode == 'shared_memory':
+            # Threads decode/encode (OpenCV releases the GIL); worker processes segment and composite
+            max_width, max_height = parse_resolution(SHM_MAX_FRAME)
+            self._worker_pool = SharedMemoryWorkerPool(
+                BackgroundReplacer, _process_shared_frame_in_worker, max_workers,
+                slots_per_worker=SHM_SLOTS_PER_WORKER, max_frame_bytes=max_width * max_height * 3,
+                stats_handler=BackgroundReplacer.stats)
+            self._executor = ThreadPoolExecutor(max_workers=max_workers * SHM_SLOTS_PER_WORKER,
+                                                thread_name_prefix='frame')
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='frame')
+        
+        # Cap queued work so a burst of frames waits here instead of piling up in the pool,
+        # and hand out the slots fairly between sessions
+        self.scheduler = FairFrameScheduler(max_workers * 2)
+        self.frames_processed = 0
+        self.frames_passed_through = 0
+        logger.info(f"Frame executor started: mode={mode}, workers={max_workers}")
+    
+    async def process(self, payload: Union[str, bytes, memoryview], session: StreamSession,
+                      codec: str = 'jpeg', source_codec: str = 'jpeg') -> Optional[Union[str, bytes]]:
+        """Process a raw or base64 frame for a session in the pool and return the result encoded with codec"""
+        if codec == source_codec and not self.replacer.requires_mask(session.background):
+            # Nothing to composite: echo the client's compressed bytes without decoding or encoding
+            self.frames_passed_through += 1
+            return bytes(payload) if isinstance(payload, memoryview) else payload
+        
+        loop = asyncio.get_running_loop()
+        async with self.scheduler.slot(session.session_id):
+            if self.mode == 'process':
+                if isinstance(payload, memoryview):
+                    payload = payload.tobytes()  # Views cannot be pickled to the worker
+                job = loop.run_in_executor(
+                    self.executor_for(session.session_id), _process_frame_in_worker, payload, codec, session,
+                    self.replacer.custom_background_files.get(session.background))
+            elif self.mode == 'shared_memory':
+                job = loop.run_in_executor(self._executor, self._process_shared, payload, codec, session)
+            else:
+                job = loop.run_in_executor(
+                    self._executor, process_frame_payload, self.replacer, payload, codec, session)
+            result = await self._finish(job)
+        self.frames_processed += 1
+        return result
+    
+    @staticmethod
+    async def _finish(job: asyncio.Future) -> Any:
+        """Await a pool job; if cancelled, keep holding the frame slot until the job has really finished"""
+        try:
+            return await asyncio.shield(job)
+        except asyncio.CancelledError:
+            # The pool keeps running a started frame, so releasing the slot now would let one
+            # more job in than the scheduler allows
+            try:
+                await asyncio.wait([job])
+            finally:
+                if job.done() and not job.cancelled():
+                    job.exception()  # Retrieved: nobody else will look at this frame's outcome
+            raise
+    
+    def executor_for(self, session_id: str) -> ProcessPoolExecutor:
+        """Pin a session to one worker process so its keyframe and mask state stay there"""
+        return self._process_executors[zlib.crc32(session_id.encode()) % len(self._process_executors)]
+    
+    def _process_shared(self, payload: Union[str, bytes, memoryview], codec: str,
+                        session: StreamSession) -> Optional[Union[str, bytes]]:
+        """Decode here, composite in the session's worker process, encode from shared memory"""
+        image_bytes = base64.b64decode(payload) if isinstance(payload, str) else payload
+        frame = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+        if frame is None:
+            return None
+        
+        if self._worker_pool.fits(frame):
+            background_file = self.replacer.custom_background_files.get(session.background)
+            with self._worker_pool.process(frame, session, background_file) as processed_frame:
+                _, buffer = cv2.imencode(CODEC_EXTENSIONS[codec], processed_frame, encode_params(codec, session))
+        else:
+            self.oversized_frames += 1
+            _, buffer = cv2.imencode(CODEC_EXTENSIONS[codec], self.replacer.process_frame(frame, session),
+                                     encode_params(codec, session))
+        
+        if isinstance(payload, str):
+            return base64.b64encode(buffer).decode('utf-8')
+        return buffer.tobytes()
+    
+    def close_session(self, session: StreamSession) -> None:
+        """Release any state a worker process holds for a finished session"""
+        self.scheduler.forget(session.session_id)
+        if self._process_executors:
+            self.executor_for(session.session_id).submit(_close_worker_session, session.session_id)
+        if self._worker_pool is not None:
+            self._worker_pool.close_session(session.session_id)
+    
+    async def worker_stats(self, timeout: float = 2.0) -> Optional[List[Optional[Dict[str, Any]]]]:
+        """Return each worker process's replacer stats (None for one that does not answer), or None in thread mode"""
+        if self.mode == 'process':
+            futures = [asyncio.wrap_future(executor.submit(_worker_replacer_stats))
+                       for executor in self._process_executors]
+            await asyncio.wait(futures, timeout=timeout)
+            results = []
+            for future in futures:
+                if future.done() and not future.cancelled() and future.exception() is None:
+                    results.append(future.result())
+                else:
+                    results.append(None)
+            return results
+        if self.mode == 'shared_memory':
+            return await asyncio.get_running_loop().run_in_executor(None, self._worker_pool.worker_stats, timeout)
+        return None
+    
+    def stats(self) -> Dict[str, Any]:
+        """Return executor settings and counters for monitoring"""
+        stats = {"mode": self.mode, "workers": self.max_workers, "frames_processed": self.frames_processed,
+                 "frames_passed_through": self.frames_passed_through, "scheduler": self.scheduler.stats()}
+        if self._worker_pool is not None:
+            stats["shared_memory"] = self._worker_pool.stats()
+            stats["oversized_frames"] = self.oversized_frames
+        return stats
+    
+    def shutdown(self) -> None:
+        """Stop the worker pool"""
+        for executor in self._process_executors:
+            executor.shutdown(wait=False, cancel_futures=True)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        if self._worker_pool is not None:
+            self._worker_pool.shutdown()
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Real-time AI Background Replacement",
@@ -251,16 +1457,52 @@ app.add_middleware(
 
 # Create backgrounds directory if it doesn't exist
 os.makedirs("backgrounds", exist_ok=True)
-
-# Mount static files for serving uploaded backgrounds
-app.mount("/backgrounds", StaticFiles(directory="backgrounds"), name="backgrounds")
+os.makedirs(BACKGROUND_DATA_DIR, exist_ok=True)
 
 # Global background replacer instance
 background_replacer = BackgroundReplacer()
 
+# Metadata of uploaded backgrounds, persisted outside the served directory and reloaded at startup
+background_index = BackgroundIndex("backgrounds", os.path.join(BACKGROUND_DATA_DIR, INDEX_FILENAME))
+
 # Store active WebSocket connections
 active_connections: list[WebSocket] = []
 
+# Per-connection stream sessions, keyed by session ID
+active_sessions: Dict[str, StreamSession] = {}
+
+# Concurrent-stream limit for /ws
+stream_admission = StreamAdmission()
+
+# Worker pool for frame processing, created when the server starts
+frame_executor: Optional[FrameExecutor] = None
+
+# Threads for upload file I/O and decoding, kept apart from the frame pool
+upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix='upload')
+
+@app.on_event("startup")
+async def start_frame_executor():
+    """Start the frame processing pool"""
+    global frame_executor
+    frame_executor = FrameExecutor(background_replacer)
+
+@app.on_event("startup")
+async def load_background_index():
+    """Register uploaded backgrounds from the index; their images are decoded on first use"""
+    records = await asyncio.get_running_loop().run_in_executor(upload_executor, background_index.load)
+    for record in records:
+        background_replacer.register_custom_background(record.background_id, background_index.file_path(record),
+                                                       record.references)
+
+@app.on_event("shutdown")
+async def stop_frame_executor():
+    """Stop the frame processing pool"""
+    if frame_executor is not None:
+        frame_executor.shutdown()
+    upload_executor.shutdown(wait=False, cancel_futures=True)
+    if background_replacer.inference_scheduler is not None:
+        background_replacer.inference_scheduler.shutdown()
+
 @app.get("/")
 async def root():
     """Root endpoint with basic info"""
@@ -277,7 +1519,30 @@ async def root():
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {"status": "healthy", "background_replacer": "initialized"}
+    health = {
+        "status": "healthy",
+        "background_replacer": "initialized",
+        "custom_backgrounds": background_replacer.custom_background_stats(),
+        "active_sessions": len(active_sessions),
+        "admission": stream_admission.stats(),
+        "frame_executor": frame_executor.stats() if frame_executor else None
+    }
+    
+    workers = await frame_executor.worker_stats() if frame_executor else None
+    if workers is None:
+        health.update(background_replacer.stats())
+    else:
+        # Frames are segmented in worker processes: report their counters, not the idle server replacer's
+        answered = [worker for worker in workers if worker is not None]
+        health.update({
+            "background_cache": None,
+            "segmenter_pool": None,
+            "segmentation": combine_segmentation_stats([worker["segmentation"] for worker in answered]),
+            "inference_scheduler": None,
+            "blur_reuses": sum(worker["blur_reuses"] for worker in answered),
+            "workers": workers,
+        })
+    return health
 
 @app.get("/backgrounds")
 async def get_available_backgrounds():
@@ -289,7 +1554,7 @@ async def get_available_backgrounds():
 
 @app.post("/background")
 async def set_background(background_data: Dict[str, Any]):
-    """Set the background type"""
+    """Set the default background type for new streams"""
     background_type = background_data.get("type")
     if not background_type:
         raise HTTPException(status_code=400, detail="Background type is required")
@@ -300,49 +1565,168 @@ async def set_background(background_data: Dict[str, Any]):
     else:
         raise HTTPException(status_code=400, detail=f"Invalid background type: {background_type}")
 
-@app.post("/upload-background")
-async def upload_background(file: UploadFile = File(...)):
-    """Upload a custom background image"""
+def _remove_file(path: str) -> None:
+    """Delete a file if it exists"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def _store_upload(path: str, content: bytes) -> None:
+    """Write an accepted upload once, beside the manifest, and rename it into the served directory"""
+    partial_path = os.path.join(BACKGROUND_DATA_DIR, f"upload_{uuid.uuid4().hex}.part")
     try:
+        with open(partial_path, "wb") as output:
+            output.write(content)
+        os.replace(partial_path, path)
+    except BaseException:
+        _remove_file(partial_path)
+        raise
+
+async def read_upload_file(request: Request, field: str = "file",
+                           max_bytes: int = MAX_UPLOAD_BYTES) -> Tuple[Optional[str], Optional[str], bytearray]:
+    """Read one file field of a multipart request into memory as the body streams in
+    
+    Returns the file's name, content type and bytes. Nothing is spooled to disk, and a request over
+    max_bytes is refused with 413 from its Content-Length, or as soon as it grows past the limit.
+    """
+    too_large = HTTPException(status_code=413, detail=f"File is larger than {max_bytes // (1024 * 1024)} MB")
+    body_limit = max_bytes + UPLOAD_FORM_OVERHEAD
+    declared_length = request.headers.get("content-length", "")
+    if declared_length.isdigit() and int(declared_length) > body_limit:
+        raise too_large
+    
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or not options.get(b"boundary"):
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data upload with a file")
+    
+    part: Dict[str, Any] = {}
+    found: Dict[str, Any] = {}
+    content = bytearray()
+    
+    def on_part_begin() -> None:
+        part.clear()
+        part.update(headers={}, field=bytearray(), value=bytearray(), target=False)
+    
+    def on_header_field(data: bytes, start: int, end: int) -> None:
+        part["field"] += data[start:end]
+    
+    def on_header_value(data: bytes, start: int, end: int) -> None:
+        part["value"] += data[start:end]
+    
+    def on_header_end() -> None:
+        part["headers"][bytes(part["field"]).lower()] = bytes(part["value"])
+        part["field"], part["value"] = bytearray(), bytearray()
+    
+    def on_headers_finished() -> None:
+        _, disposition = parse_options_header(part["headers"].get(b"content-disposition", b""))
+        if disposition.get(b"name", b"").decode("latin-1") == field and b"filename" in disposition and not found:
+            part["target"] = True
+            found["filename"] = disposition[b"filename"].decode("utf-8", "replace")
+            found["content_type"] = part["headers"].get(b"content-type", b"").decode("latin-1") or None
+    
+    def on_part_data(data: bytes, start: int, end: int) -> None:
+        if part["target"]:
+            content.extend(data[start:end])
+            if len(content) > max_bytes:
+                raise too_large
+    
+    parser = MultipartParser(options[b"boundary"], {
+        "on_part_begin": on_part_begin, "on_header_field": on_header_field, "on_header_value": on_header_value,
+        "on_header_end": on_header_end, "on_headers_finished": on_headers_finished, "on_part_data": on_part_data})
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > body_limit:
+            raise too_large
+        parser.write(chunk)
+    parser.finalize()
+    
+    if not found:
+        raise HTTPException(status_code=400, detail=f"No '{field}' file in the upload")
+    return found["filename"], found["content_type"], content
+
+@app.post("/upload-background", openapi_extra={"requestBody": {"required": True, "content": {"multipart/form-data": {
+    "schema": {"type": "object", "required": ["file"],
+               "properties": {"file": {"type": "string", "format": "binary"}}}}}}})
+async def upload_background(request: Request):
+    """Upload a custom background image; identical images share one ID, file and decoded copy"""
+    try:
+        filename, content_type, content = await read_upload_file(request)
+        
         # Validate file type
-        if not file.content_type or not file.content_type.startswith('image/'):
+        if not content_type or not content_type.startswith('image/'):
             raise HTTPException(status_code=400, detail="File must be an image")
         
-        # Generate unique filename
-        file_extension = file.filename.split('.')[-1] if '.' in file.filename else 'jpg'
-        background_id = f"custom_{uuid.uuid4().hex[:8]}"
-        filename = f"{background_id}.{file_extension}"
-        file_path = os.path.join("backgrounds", filename)
-        
-        # Save file
-        with open(file_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
+        file_extension = filename.rsplit('.', 1)[-1].lower() if filename and '.' in filename else 'jpg'
+        if not file_extension.isalnum():
+            file_extension = 'jpg'
         
-        # Load and process the image
-        image = cv2.imread(file_path)
-        if image is None:
-            os.remove(file_path)  # Clean up invalid file
-            raise HTTPException(status_code=400, detail="Invalid image file")
+        # Hashing, decoding and file I/O run off the event loop
+        loop = asyncio.get_running_loop()
+        digest = await loop.run_in_executor(upload_executor, hashlib.sha256, content)
+        # The ID comes from the content, so a repeat upload finds the background already loaded
+        background_id = f"custom_{digest.hexdigest()[:16]}"
+        deduplicated = background_replacer.retain_custom_background(background_id)
+        if not deduplicated:
+            # Decode straight from the uploaded bytes; nothing has touched the disk yet
+            try:
+                image = await loop.run_in_executor(upload_executor, decode_background, content)
+            except ValueError as e:
+                raise HTTPException(status_code=413, detail=str(e))
+            if image is None:
+                raise HTTPException(status_code=400, detail="Invalid image file")
+            # An identical upload may have finished while this one was decoding
+            deduplicated = background_replacer.retain_custom_background(background_id)
         
-        # Convert BGR to RGB for consistency
-        image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        if deduplicated:
+            file_path = background_replacer.custom_background_files[background_id]
+        else:
+            # Claim the ID before the next await so identical uploads in flight count as references
+            file_path = os.path.join("backgrounds", f"{background_id}.{file_extension}")
+            background_replacer.custom_background_files[background_id] = file_path
+            if not background_replacer.add_custom_background(background_id, image):
+                raise HTTPException(status_code=500, detail="Could not store background")
+            try:
+                await loop.run_in_executor(upload_executor, _store_upload, file_path, content)
+            except BaseException:
+                background_replacer.release_custom_background(background_id)
+                raise
         
-        # Add to background replacer
-        success = background_replacer.add_custom_background(background_id, image_rgb)
-        logger.info(f"Custom background upload result: success={success}, background_id={background_id}")
+        success = True
+        if deduplicated:
+            record = background_index.get(background_id)
+            if record is not None:  # Otherwise the first upload is still being rendered and records it
+                background_index.put(record._replace(
+                    references=background_replacer.custom_background_refs[background_id]))
+        else:
+            await loop.run_in_executor(upload_executor, background_replacer.prerender_custom_background,
+                                       background_id)
+            # Deleted while rendering: keep it out of the index
+            success = background_replacer.has_custom_background(background_id)
+            if success:
+                background_index.put(BackgroundRecord(
+                    background_id, digest.hexdigest(), os.path.basename(file_path), image.shape[1], image.shape[0],
+                    background_replacer.custom_background_refs.get(background_id, 1)))
+        if success:
+            await loop.run_in_executor(upload_executor, background_index.save)
+        logger.info(f"Custom background upload result: success={success}, background_id={background_id}, "
+                    f"deduplicated={deduplicated}")
         
         if success:
+            filename = os.path.basename(file_path)
             return {
                 "message": "Background uploaded successfully",
                 "background_id": background_id,
                 "filename": filename,
                 "url": f"/backgrounds/{filename}",
+                "deduplicated": deduplicated,
+                "references": background_replacer.custom_background_refs.get(background_id, 1),
                 "success": True
             }
         else:
-            os.remove(file_path)  # Clean up on failure
-            raise HTTPException(status_code=500, detail="Failed to process background image")
+            await loop.run_in_executor(upload_executor, _remove_file, file_path)
+            raise HTTPException(status_code=500, detail="Could not store background")
             
     except HTTPException:
         raise
@@ -350,25 +1734,52 @@ async def upload_background(file: UploadFile = File(...)):
         logger.error(f"Error uploading background: {e}")
         raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
 
-@app.get("/backgrounds/list")
-async def list_backgrounds():
-    """Get list of all available backgrounds including custom ones"""
-    custom_backgrounds = []
-    for bg_id in background_replacer.custom_backgrounds.keys():
-        # Find the corresponding file
-        for filename in os.listdir("backgrounds"):
-            if filename.startswith(bg_id):
-                custom_backgrounds.append({
-                    "id": bg_id,
-                    "name": f"Custom {bg_id[:8]}",
-                    "type": "custom",
-                    "url": f"/backgrounds/{filename}"
-                })
-                break
+@app.delete("/background/{background_id}")
+async def delete_background(background_id: str):
+    """Drop one upload of a custom background; its file and image go once no upload refers to it"""
+    if not background_replacer.has_custom_background(background_id):
+        raise HTTPException(status_code=404, detail=f"Unknown custom background: {background_id}")
     
+    loop = asyncio.get_running_loop()
+    file_path = background_replacer.release_custom_background(background_id)
+    references = background_replacer.custom_background_refs.get(background_id, 0)
+    record = background_index.get(background_id)
+    if references:
+        if record is not None:
+            background_index.put(record._replace(references=references))
+    else:
+        background_index.remove(background_id)
+    await loop.run_in_executor(upload_executor, background_index.save)
+    if file_path is not None:
+        await loop.run_in_executor(upload_executor, _remove_file, file_path)
+    return {
+        "message": f"Background {background_id} released",
+        "removed": not background_replacer.has_custom_background(background_id),
+        "references": references,
+        "success": True
+    }
+
+@app.get("/backgrounds/list")
+async def list_backgrounds(offset: int = Query(0, ge=0), limit: int = Query(BACKGROUND_PAGE_SIZE, ge=1, le=1000)):
+    """Get list of all available backgrounds including custom ones, a page of custom ones at a time"""
+    # Served from the in-memory index, kept in sync by upload and delete
+    records = background_index.page(offset, limit)
+    total = len(background_index)
+    next_offset = offset + len(records)
     return {
         "predefined": list(background_replacer.backgrounds.keys()),
-        "custom": custom_backgrounds,
+        "custom": [{
+            "id": record.background_id,
+            "name": f"Custom {record.background_id.removeprefix('custom_')[:8]}",
+            "type": "custom",
+            "url": f"/backgrounds/{record.filename}",
+            "width": record.width,
+            "height": record.height,
+            "references": record.references
+        } for record in records],
+        "total": total,
+        "offset": offset,
+        "next_offset": next_offset if next_offset < total else None,
         "current": background_replacer.current_background
     }
 
@@ -376,72 +1787,167 @@ async def list_backgrounds():
 async def websocket_endpoint(websocket: WebSocket):
     """WebSocket endpoint for real-time video processing"""
     await websocket.accept()
+    if not stream_admission.has_capacity() and stream_admission.policy == 'queue':
+        await websocket.send_text(json.dumps({"type": "queued", "position": stream_admission.waiting + 1}))
+    if not await stream_admission.admit():
+        logger.info(f"WebSocket rejected: {stream_admission.active} of {stream_admission.max_streams} streams in use")
+        await websocket.send_text(json.dumps({"type": "error", "message": "Server is at capacity, try again later"}))
+        await websocket.close(code=1013)  # Try Again Later
+        return
+    
     active_connections.append(websocket)
     logger.info(f"WebSocket connected. Total connections: {len(active_connections)}")
+    output_codec = None  # Codec for binary replies, negotiated with a "hello" message
+    session = StreamSession(background_replacer.current_background)
+    active_sessions[session.session_id] = session
+    mailbox = FrameMailbox()
+    quality = QualityController()
+    send_lock = asyncio.Lock()  # Replies come from both the receive loop and the frame task
+    
+    async def send_json(payload: Dict[str, Any]) -> None:
+        async with send_lock:
+            await websocket.send_text(json.dumps(payload))
+    
+    async def process_frames() -> None:
+        """Process the newest waiting frame, one at a time, until the socket closes"""
+        reported_drops = 0
+        while True:
+            pending = await mailbox.get()
+            try:
+                # Decode, segment, composite and encode in the worker pool
+                source_codec = pending.header.codec if pending.header is not None else 'jpeg'
+                processed = await frame_executor.process(pending.payload, session, pending.codec, source_codec)
+                if processed is None:
+                    continue
+                
+                if pending.header is not None:
+                    reply = FrameHeader(MSG_PROCESSED_FRAME, pending.codec, pending.header.sequence, pending.header.timestamp)
+                    async with send_lock:
+                        await websocket.send_bytes(pack_frame(reply, processed))
+                else:
+                    # Send processed frame back
+                    await send_json({
+                        "type": "processed_frame",
+                        "data": processed,
+                        "background": session.background,
+                        "timestamp": pending.timestamp,
+                        "dropped_frames": mailbox.dropped
+                    })
+                
+                decision = quality.observe(session, (time.time() - pending.received) * 1000,
+                                           pending.timestamp, pending.received)
+                if decision is not None:
+                    # Tell the client what was traded away (or restored) to hold its latency target
+                    await send_json({"type": "quality_adjusted", **decision})
+                
+                if mailbox.dropped > reported_drops:
+                    # Tell the client it is sending faster than frames can be processed
+                    await send_json({
+                        "type": "frames_dropped",
+                        "dropped": mailbox.dropped - reported_drops,
+                        "total": mailbox.dropped
+                    })
+                    reported_drops = mailbox.dropped
+            except Exception as e:
+                logger.error(f"Error processing frame: {e}")
+                await send_json({
+                    "type": "error",
+                    "message": str(e)
+                })
+    
+    frame_task = asyncio.create_task(process_frames())
     
     try:
         while True:
             # Receive data from client
-            data = await websocket.receive_text()
+            received = await websocket.receive()
+            if received["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(received.get("code", 1000))
+            
+            if received.get("bytes") is not None:
+                # Binary frame: fixed header followed by the compressed image
+                try:
+                    header, image_bytes = unpack_frame(received["bytes"])
+                    if header.message_type != MSG_FRAME:
+                        raise ValueError(f"Unexpected binary message type: {header.message_type}")
+                    mailbox.put(PendingFrame(image_bytes, output_codec or header.codec, header,
+                                             header.timestamp, time.time()))
+                except ValueError as e:
+                    await send_json({
+                        "type": "error",
+                        "message": str(e)
+                    })
+                continue
             
+            data = received.get("text")
             try:
                 # Parse the incoming data
                 message = json.loads(data)
                 
                 if message.get("type") == "frame":
-                    # Process video frame
+                    # Queue video frame; a newer frame replaces it if processing falls behind
                     frame_data = message.get("data")
+                    session.update_settings(message.get("settings"))
                     if frame_data:
-                        # Decode base64 image
-                        image_bytes = base64.b64decode(frame_data)
-                        nparr = np.frombuffer(image_bytes, np.uint8)
-                        frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-                        
-                        if frame is not None:
-                            # Process frame with background replacement
-                            processed_frame = background_replacer.process_frame(frame)
-                            
-                            # Encode processed frame back to base64
-                            _, buffer = cv2.imencode('.jpg', processed_frame)
-                            processed_data = base64.b64encode(buffer).decode('utf-8')
-                            
-                            # Send processed frame back
-                            response = {
-                                "type": "processed_frame",
-                                "data": processed_data,
-                                "background": background_replacer.current_background
-                            }
-                            await websocket.send_text(json.dumps(response))
+                        mailbox.put(PendingFrame(frame_data, 'jpeg', None, message.get("timestamp"), time.time()))
                 
                 elif message.get("type") == "set_background" or message.get("type") == "change_background":
                     # Change background
                     bg_type = message.get("background")
                     logger.info(f"Received background change request: {bg_type}")
                     if bg_type:
-                        success = background_replacer.set_background(bg_type)
+                        success = background_replacer.set_background(bg_type, session)
                         response = {
                             "type": "background_changed",
                             "background": bg_type,
                             "success": success
                         }
                         logger.info(f"Sending background change response: {response}")
-                        await websocket.send_text(json.dumps(response))
+                        await send_json(response)
+                
+                elif message.get("type") == "hello":
+                    # Negotiate the frame protocol; binary frames may be sent after this
+                    protocol = message.get("protocol", "json")
+                    codec = message.get("codec", "jpeg")
+                    if protocol not in ("json", "binary") or codec not in CODEC_IDS:
+                        raise ValueError(f"Unsupported protocol/codec: {protocol}/{codec}")
+                    output_codec = codec if protocol == "binary" else None
+                    session.update_settings(message.get("settings"))
+                    await send_json({
+                        "type": "hello",
+                        "protocol": protocol,
+                        "codec": codec,
+                        "codecs": list(CODEC_IDS),
+                        "header_format": FRAME_HEADER.format,
+                        "session_id": session.session_id,
+                        "mailbox_slots": mailbox.slots,
+                        "quality": quality.decision(session)
+                    })
+                
+                elif message.get("type") == "settings":
+                    # Change settings without a frame; binary frames have no room for them
+                    session.update_settings(message.get("settings"))
+                    await send_json({
+                        "type": "settings",
+                        "settings": session.settings,
+                        "quality": quality.decision(session)
+                    })
                 
                 elif message.get("type") == "ping":
                     # Respond to ping
-                    await websocket.send_text(json.dumps({"type": "pong"}))
+                    await send_json({"type": "pong"})
                 
             except json.JSONDecodeError:
-                await websocket.send_text(json.dumps({
+                await send_json({
                     "type": "error",
                     "message": "Invalid JSON format"
-                }))
+                })
             except Exception as e:
                 logger.error(f"Error processing message: {e}")
-                await websocket.send_text(json.dumps({
+                await send_json({
                     "type": "error",
                     "message": str(e)
-                }))
+                })
                 
     except WebSocketDisconnect:
         active_connections.remove(websocket)
@@ -450,6 +1956,15 @@ async def websocket_endpoint(websocket: WebSocket):
         logger.error(f"WebSocket error: {e}")
         if websocket in active_connections:
             active_connections.remove(websocket)
+    finally:
+        frame_task.cancel()
+        # Let a frame still in the pool finish so the session is closed after its last frame
+        await asyncio.gather(frame_task, return_exceptions=True)
+        stream_admission.release()
+        active_sessions.pop(session.session_id, None)
+        frame_executor.close_session(session)
+        if mailbox.dropped:
+            logger.info(f"Connection dropped {mailbox.dropped} of {mailbox.received} frames under load")
 
 @app.get("/test")
 async def test_endpoint():
@@ -461,6 +1976,9 @@ async def test_endpoint():
         "current_background": background_replacer.current_background
     }
 
+# Mount static files for serving uploaded backgrounds; after the routes so /backgrounds/list is not shadowed
+app.mount("/backgrounds", StaticFiles(directory="backgrounds"), name="backgrounds")
+
 def main():
     """Main function to run the server"""
     logger.info("Starting Real-time AI Background Replacement Server...")
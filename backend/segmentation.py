@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+Segmentation model management and mask refinement for the background replacement server
+"""
+
+import functools
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Protocol, Sequence, Tuple
+
+import cv2
+import mediapipe as mp
+import numpy as np
+
+try:
+    import onnxruntime
+except ImportError:  # Optional: only the onnx backend needs it
+    onnxruntime = None
+
+logger = logging.getLogger(__name__)
+
+SEGMENTATION_BACKENDS = ('mediapipe', 'onnx')
+
+# Width of the grid masks are propagated on between keyframes; matches the landscape model's output width
+FLOW_WIDTH = 256
+
+
+class Segmenter(Protocol):
+    """A person segmentation engine; instances are checked out of a SegmenterPool one thread at a time"""
+
+    def process(self, batch: Sequence[np.ndarray]) -> List[np.ndarray]:
+        """Return a float32 person mask (0-1) at the size of each RGB uint8 frame in the batch"""
+        ...
+
+
+class MediaPipeSegmenter:
+    """MediaPipe Selfie Segmentation graph"""
+
+    def __init__(self, model_selection: int = 1):
+        """Build the graph; model_selection=1 is the faster landscape model"""
+        self._graph = mp.solutions.selfie_segmentation.SelfieSegmentation(model_selection=model_selection)
+
+    def process(self, batch: Sequence[np.ndarray]) -> List[np.ndarray]:
+        """Segment each frame in turn; the graph has no batch input"""
+        return [self._graph.process(frame).segmentation_mask for frame in batch]
+
+
+class OnnxSegmenter:
+    """Segmentation model exported to ONNX, run with ONNX Runtime on the CPU"""
+
+    def __init__(self, model_path: str, threads: int = 0):
+        """Load a model taking RGB images scaled to 0-1 (NHWC or NCHW) and returning one mask channel
+
+        threads sets ONNX Runtime's intra-op thread count (0 = one per core).
+        """
+        if onnxruntime is None:
+            raise RuntimeError("The onnx segmentation backend needs onnxruntime (pip install onnxruntime)")
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        self._session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+
+        model_input = self._session.get_inputs()[0]
+        self._input_name = model_input.name
+        batch_size, *dims = model_input.shape
+        self._channels_first = dims[0] == 3
+        self._height, self._width = dims[1:] if self._channels_first else dims[:2]
+        if not isinstance(self._height, int) or not isinstance(self._width, int):
+            raise ValueError(f"{model_path} needs a fixed input size, got {model_input.shape}")
+        # Models exported with a fixed batch of 1 are run frame by frame
+        self._fixed_batch = batch_size == 1
+        logger.info(f"Loaded ONNX segmentation model {model_path} ({self._width}x{self._height})")
+
+    def process(self, batch: Sequence[np.ndarray]) -> List[np.ndarray]:
+        """Resize the batch to the model's input, run it once, and resize each mask back"""
+        inputs = np.stack([cv2.resize(frame, (self._width, self._height), interpolation=cv2.INTER_AREA)
+                           for frame in batch]).astype(np.float32) * (1 / 255)
+        if self._channels_first:
+            inputs = inputs.transpose(0, 3, 1, 2)
+
+        if self._fixed_batch:
+            outputs = [self._session.run(None, {self._input_name: inputs[i:i + 1]})[0] for i in range(len(batch))]
+        else:
+            outputs = self._session.run(None, {self._input_name: inputs})
+        masks = np.concatenate(outputs).reshape(len(batch), self._height, self._width)
+        return [cv2.resize(mask, (frame.shape[1], frame.shape[0]), interpolation=cv2.INTER_LINEAR)
+                for mask, frame in zip(masks, batch)]
+
+
+def segmenter_factory(backend: str, model_path: Optional[str] = None, threads: int = 0) -> Callable[[], Segmenter]:
+    """Return a constructor for the chosen backend, failing now rather than on the first frame"""
+    if backend == 'mediapipe':
+        return MediaPipeSegmenter
+    if backend == 'onnx':
+        if onnxruntime is None:
+            raise RuntimeError("The onnx segmentation backend needs onnxruntime (pip install onnxruntime)")
+        if not model_path or not os.path.isfile(model_path):
+            raise FileNotFoundError(f"ONNX segmentation model not found: {model_path!r} (set ONNX_MODEL_PATH)")
+        return functools.partial(OnnxSegmenter, model_path, threads)
+    raise ValueError(f"Unknown segmentation backend: {backend} (choose from {', '.join(SEGMENTATION_BACKENDS)})")
+
+
+class SegmenterPool:
+    """Pool of segmentation graphs with checkout/checkin, so threads can run inference in parallel"""
+
+    def __init__(self, factory: Callable[[], Any], size: int):
+        """Create a pool of up to size segmenters, built lazily with factory"""
+        self.factory = factory
+        self.size = max(1, size)
+        self.created = 0
+        self.checkouts = 0
+        self.waits = 0  # Checkouts that had to wait for another thread to check in
+        self._idle: "queue.LifoQueue[Any]" = queue.LifoQueue()
+        self._lock = threading.Lock()
+
+    def _acquire(self) -> Any:
+        """Take an idle segmenter, creating one if the pool is not full yet"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            create = self.created < self.size
+            if create:
+                self.created += 1
+        if create:
+            logger.info(f"Creating segmenter {self.created}/{self.size}")
+            try:
+                return self.factory()
+            except Exception:
+                with self._lock:
+                    self.created -= 1
+                raise
+
+        with self._lock:
+            self.waits += 1
+        return self._idle.get()
+
+    @contextmanager
+    def checkout(self) -> Iterator[Any]:
+        """Borrow a segmenter for the duration of the with-block"""
+        segmenter = self._acquire()
+        with self._lock:
+            self.checkouts += 1
+        try:
+            yield segmenter
+        finally:
+            self._idle.put(segmenter)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return pool counters for monitoring"""
+        with self._lock:
+            return {
+                "size": self.size,
+                "created": self.created,
+                "idle": self._idle.qsize(),
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+            }
+
+
+class InferenceScheduler:
+    """Collects frames from all sessions for up to a deadline and segments them as one batch"""
+
+    def __init__(self, pool: SegmenterPool, deadline: float, max_batch: int = 8):
+        """Start a batching thread and one runner per segmenter; deadline is seconds from a batch's first frame"""
+        self.pool = pool
+        self.deadline = deadline
+        self.max_batch = max(1, max_batch)
+        self.batches = 0
+        self.frames = 0
+        self.batch_sizes: Dict[int, int] = {}  # Histogram: batch size -> batches
+        self._wait_seconds = 0.0  # Time frames spent queued before their batch ran
+        self._max_wait = 0.0
+        self._queue: "queue.Queue[Optional[Tuple[np.ndarray, float, Future]]]" = queue.Queue()
+        self._lock = threading.Lock()
+        # A single collector forms the batches so concurrent frames end up together; the
+        # runners only segment them, so batches keep forming while earlier ones are still running
+        self._runners = ThreadPoolExecutor(max_workers=pool.size, thread_name_prefix="inference-runner")
+        self._collector = threading.Thread(target=self._run, name="inference-batcher", daemon=True)
+        self._collector.start()
+
+    def process(self, frame: np.ndarray) -> np.ndarray:
+        """Queue an RGB frame for the next batch and wait for its mask"""
+        future: Future = Future()
+        self._queue.put((frame, time.perf_counter(), future))
+        return future.result()
+
+    def _collect(self) -> Optional[List[Tuple[np.ndarray, float, Future]]]:
+        """Wait for a frame, then gather more until the deadline or the batch is full"""
+        first = self._queue.get()
+        if first is None:
+            return None
+
+        batch = [first]
+        deadline = first[1] + self.deadline
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)  # Stop after this batch
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self) -> None:
+        """Batching thread: collect batches and hand each to a free runner"""
+        while True:
+            batch = self._collect()
+            if batch is None:
+                break
+            self._runners.submit(self._segment, batch)
+
+    def _segment(self, batch: List[Tuple[np.ndarray, float, Future]]) -> None:
+        """Runner: segment one batch and scatter the masks back to their callers"""
+        start = time.perf_counter()
+        waits = [start - queued for _, queued, _ in batch]
+        with self._lock:
+            self.batches += 1
+            self.frames += len(batch)
+            self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+            self._wait_seconds += sum(waits)
+            self._max_wait = max(self._max_wait, *waits)
+
+        try:
+            with self.pool.checkout() as segmenter:
+                masks = segmenter.process([frame for frame, _, _ in batch])
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, _, future), mask in zip(batch, masks):
+            future.set_result(mask)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return queue depth, the batch size histogram and the latency batching added"""
+        with self._lock:
+            return {
+                "deadline_ms": self.deadline * 1000,
+                "max_batch": self.max_batch,
+                "queue_depth": self._queue.qsize(),
+                "batches": self.batches,
+                "frames": self.frames,
+                "batch_sizes": dict(sorted(self.batch_sizes.items())),
+                "avg_wait_ms": 1000 * self._wait_seconds / self.frames if self.frames else 0.0,
+                "max_wait_ms": 1000 * self._max_wait,
+            }
+
+    def shutdown(self) -> None:
+        """Stop the batching thread and runners once queued frames are done"""
+        self._queue.put(None)
+        self._collector.join(timeout=5)
+        self._runners.shutdown(wait=True)
+
+
+def _guided_coefficients(guide: np.ndarray, src: np.ndarray, radius: int, eps: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the smoothed linear coefficients (a, b) of a guided filter, so that output = a * guide + b"""
+    ksize = (2 * radius + 1, 2 * radius + 1)
+    mean_i = cv2.boxFilter(guide, -1, ksize)
+    mean_p = cv2.boxFilter(src, -1, ksize)
+    cov_ip = cv2.boxFilter(guide * src, -1, ksize) - mean_i * mean_p
+    var_i = cv2.boxFilter(guide * guide, -1, ksize) - mean_i * mean_i
+
+    a = cov_ip / (var_i + eps)
+    b = mean_p - a * mean_i
+    return cv2.boxFilter(a, -1, ksize), cv2.boxFilter(b, -1, ksize)
+
+
+def _gray(image: np.ndarray) -> np.ndarray:
+    """Convert a BGR uint8 image to a float32 grayscale guide in [0, 1]"""
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY).astype(np.float32) * (1.0 / 255)
+
+
+def guided_filter(mask: np.ndarray, guide_image: np.ndarray, radius: int = 4, eps: float = 1e-3) -> np.ndarray:
+    """Smooth a mask while snapping its edges to edges in the same-size BGR guide image"""
+    a, b = _guided_coefficients(_gray(guide_image), mask.astype(np.float32, copy=False), radius, eps)
+    return np.clip(a * _gray(guide_image) + b, 0.0, 1.0)
+
+
+def guided_upsample(mask: np.ndarray, guide_small: np.ndarray, guide_full: np.ndarray,
+                    radius: int = 4, eps: float = 1e-3) -> np.ndarray:
+    """Upsample a low-resolution mask to full size so its edges follow the full-resolution image
+
+    This is the fast guided filter: the filter coefficients are fitted at the
+    mask's resolution, upsampled bilinearly, then applied to the full-size guide.
+    """
+    height, width = guide_full.shape[:2]
+    a, b = _guided_coefficients(_gray(guide_small), mask.astype(np.float32, copy=False), radius, eps)
+    a = cv2.resize(a, (width, height), interpolation=cv2.INTER_LINEAR)
+    b = cv2.resize(b, (width, height), interpolation=cv2.INTER_LINEAR)
+    return np.clip(a * _gray(guide_full) + b, 0.0, 1.0)
+
+
+def flow_guide(frame: np.ndarray) -> np.ndarray:
+    """Shrink a BGR frame to the small grayscale image optical flow runs on"""
+    height = max(1, round(frame.shape[0] * FLOW_WIDTH / frame.shape[1]))
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, (FLOW_WIDTH, height), interpolation=cv2.INTER_AREA)
+
+
+def propagate_mask(mask: np.ndarray, previous_guide: np.ndarray, guide: np.ndarray) -> np.ndarray:
+    """Warp the previous frame's mask onto the current frame with dense optical flow
+
+    The mask must be at flow-guide resolution. Flow is computed backwards (current
+    to previous) so every pixel samples the mask where it came from.
+    """
+    # DIS at its fastest preset is several times cheaper than Farneback and plenty for a soft mask
+    flow = cv2.DISOpticalFlow_create(cv2.DISOPTICAL_FLOW_PRESET_ULTRAFAST).calc(guide, previous_guide, None)
+    height, width = guide.shape
+    y, x = np.indices((height, width), dtype=np.float32)
+    flow[..., 0] += x
+    flow[..., 1] += y
+    return cv2.remap(mask, flow, None, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
@@ -6,9 +6,19 @@ Test script to verify the background replacement server works
 import asyncio
 import json
 import base64
+import os
+import tempfile
 import numpy as np
 import cv2
-from main import BackgroundReplacer
+import threading
+import time
+from main import (QUALITY_LEVELS, BackgroundCache, BackgroundReplacer, FairFrameScheduler, FrameExecutor, FrameHeader,
+                  FrameMailbox, MSG_FRAME, decode_background, PendingFrame, QualityController, StreamAdmission, StreamSession, pack_frame,
+                  combine_segmentation_stats, process_encoded_frame, process_frame_payload, unpack_frame)
+import segmentation
+from background_index import BackgroundIndex, BackgroundRecord
+from segmentation import InferenceScheduler, MediaPipeSegmenter, OnnxSegmenter, SegmenterPool, segmenter_factory
+from worker_pool import SharedMemoryWorkerPool
 
 def test_background_replacer():
     """Test the BackgroundReplacer class"""
@@ -44,6 +54,759 @@ def test_background_replacer():
         print(f"❌ BackgroundReplacer test failed: {e}")
         return False
 
+def test_native_resolution_backgrounds():
+    """Test that predefined backgrounds are rendered at the frame size and cached"""
+    print("Testing native resolution backgrounds...")
+    
+    replacer = BackgroundReplacer()
+    replacer.set_background('office')
+    
+    frame = np.random.randint(0, 255, (1080, 1920, 3), dtype=np.uint8)
+    processed_frame = replacer.process_frame(frame)
+    assert processed_frame.shape == frame.shape
+    
+    background = replacer.get_predefined_background('office', 1920, 1080)
+    assert background.shape == (1080, 1920, 3)
+    assert replacer.get_predefined_background('office', 1920, 1080) is background
+    print("✅ 1920x1080 background rendered natively and cached")
+    
+    # One-pixel-wide frames must not hit read-only broadcast views
+    for name in ('office', 'nature', 'space', 'gradient'):
+        assert replacer.get_predefined_background(name, 1, 48).shape == (48, 1, 3)
+    print("✅ 1-pixel-wide backgrounds rendered")
+    return True
+
+def test_background_cache():
+    """Test LRU eviction and counters of the background cache"""
+    print("Testing background cache...")
+    
+    image_bytes = 480 * 640 * 3
+    cache = BackgroundCache(max_bytes=2 * image_bytes)
+    render = lambda: np.zeros((480, 640, 3), dtype=np.uint8)
+    
+    cache.get('office', 480, 640, np.uint8, render)
+    cache.get('nature', 480, 640, np.uint8, render)
+    cache.get('office', 480, 640, np.uint8, render)  # office becomes most recent
+    cache.get('beach', 480, 640, np.uint8, render)   # evicts nature
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"]) == (1, 3, 1)
+    assert stats["bytes"] <= stats["max_bytes"]
+    cache.get('nature', 480, 640, np.uint8, render)
+    assert cache.stats()["misses"] == 4
+    print("✅ LRU eviction respects the byte budget")
+    
+    replacer = BackgroundReplacer()
+    replacer.add_custom_background('custom_test', np.zeros((300, 400, 3), dtype=np.uint8))
+    replacer.set_background('custom_test')
+    frame = np.random.randint(0, 255, (480, 640, 3), dtype=np.uint8)
+    for _ in range(3):
+        replacer.process_frame(frame)
+    background = replacer.get_custom_background('custom_test', 640, 480)
+    assert background.shape == (480, 640, 3)
+    assert replacer.background_cache.stats()["misses"] <= 1
+    print("✅ Custom background resized once per resolution")
+    
+    replacer = BackgroundReplacer()
+    replacer.add_custom_background('custom_prerendered', np.zeros((1080, 1920, 3), dtype=np.uint8))
+    replacer.prerender_custom_background('custom_prerendered', "640x480,1280x720")
+    assert replacer.background_cache.stats()["entries"] == 2
+    replacer.get_custom_background('custom_prerendered', 1280, 720)
+    stats = replacer.background_cache.stats()
+    assert (stats["prefilled"], stats["hits"], stats["misses"]) == (2, 1, 0)
+    
+    # Pre-rendering only uses spare room, and live backgrounds push pre-rendered ones out first
+    frame_bytes = 480 * 640 * 3
+    replacer.background_cache = BackgroundCache(max_bytes=2 * frame_bytes)
+    replacer.add_custom_background('custom_live', np.zeros((1080, 1920, 3), dtype=np.uint8))
+    replacer.get_custom_background('custom_live', 640, 480)
+    assert replacer.prerender_custom_background('custom_prerendered', "640x480,1280x720") == 1
+    replacer.get_custom_background('custom_live', 640, 360)
+    stats = replacer.background_cache.stats()
+    assert stats["evictions"] == 1 and stats["entries"] == 2
+    replacer.get_custom_background('custom_live', 640, 480)
+    assert replacer.background_cache.stats()["hits"] == 1
+    replacer.release_custom_background('custom_live')
+    print("✅ Custom background pre-rendered into spare cache room without evicting live ones")
+    
+    # Identical uploads share one image, counted by reference
+    assert replacer.retain_custom_background('custom_prerendered')
+    assert not replacer.retain_custom_background('custom_missing')
+    stats = replacer.custom_background_stats()
+    assert (stats["backgrounds"], stats["uploads"]) == (1, 2)
+    assert stats["deduplicated_bytes"] == stats["bytes"] == 1080 * 1920 * 3
+    replacer.custom_background_files['custom_prerendered'] = 'backgrounds/custom_prerendered.jpg'
+    assert replacer.release_custom_background('custom_prerendered') is None
+    assert replacer.has_background('custom_prerendered')
+    assert replacer.release_custom_background('custom_prerendered') == 'backgrounds/custom_prerendered.jpg'
+    assert not replacer.has_background('custom_prerendered')
+    assert replacer.background_cache.stats()["entries"] == 0
+    print("✅ Duplicate uploads share one image until the last reference is released")
+    return True
+
+def test_binary_frame_protocol():
+    """Test the binary /ws frame header and raw payload processing"""
+    print("Testing binary frame protocol...")
+    
+    test_image = np.random.randint(0, 255, (480, 640, 3), dtype=np.uint8)
+    _, buffer = cv2.imencode('.jpg', test_image)
+    message = pack_frame(FrameHeader(MSG_FRAME, 'jpeg', 42, 1700000000000.5), buffer.tobytes())
+    
+    header, image_bytes = unpack_frame(message)
+    assert header == FrameHeader(MSG_FRAME, 'jpeg', 42, 1700000000000.5)
+    assert bytes(image_bytes) == buffer.tobytes()
+    print("✅ Header round-trips")
+    
+    replacer = BackgroundReplacer()
+    processed = process_frame_payload(replacer, image_bytes, 'webp')
+    assert cv2.imdecode(np.frombuffer(processed, np.uint8), cv2.IMREAD_COLOR).shape == (480, 640, 3)
+    processed_b64 = process_frame_payload(replacer, base64.b64encode(buffer).decode('utf-8'))
+    assert isinstance(processed_b64, str)
+    print("✅ Raw and base64 payloads processed")
+    return True
+
+def test_frame_mailbox():
+    """Test that the mailbox keeps only the newest frames and counts drops"""
+    print("Testing frame mailbox...")
+    
+    async def run():
+        mailbox = FrameMailbox(slots=1)
+        for i in range(5):
+            mailbox.put(PendingFrame(f"frame-{i}", 'jpeg', None))
+        newest = await mailbox.get()
+        assert newest.payload == "frame-4"
+        assert (mailbox.received, mailbox.dropped) == (5, 4)
+        
+        waiter = asyncio.create_task(mailbox.get())
+        await asyncio.sleep(0)
+        mailbox.put(PendingFrame("frame-5", 'jpeg', None))
+        assert (await waiter).payload == "frame-5"
+    
+    asyncio.run(run())
+    print("✅ Stale frames dropped, newest frame processed")
+    return True
+
+def test_decode_background():
+    """Test that uploads decode from memory and oversized images are refused"""
+    print("Testing background decoding...")
+    
+    image = np.zeros((120, 160, 3), dtype=np.uint8)
+    image[..., 2] = 255  # Red in BGR
+    _, encoded = cv2.imencode('.png', image)
+    decoded = decode_background(encoded.tobytes())
+    assert decoded.shape == image.shape
+    assert decoded[0, 0].tolist() == [0, 0, 255], "background not kept in BGR"
+    
+    # Capped to the maximum resolution in either orientation, keeping the aspect ratio
+    assert decode_background(encoded.tobytes(), max_resolution=(80, 40)).shape == (40, 53, 3)
+    portrait = cv2.imencode('.png', np.zeros((160, 120, 3), dtype=np.uint8))[1].tobytes()
+    assert decode_background(portrait, max_resolution=(80, 40)).shape == (53, 40, 3)
+    assert decode_background(b"not an image") is None
+    
+    # Oversized images are refused from their header, before any pixels are decoded
+    huge = cv2.imencode('.png', np.zeros((3000, 4000), dtype=np.uint8))[1].tobytes()
+    imdecode = cv2.imdecode
+    cv2.imdecode = lambda *args: (_ for _ in ()).throw(AssertionError("oversized image was decoded"))
+    try:
+        decode_background(huge, max_pixels=1_000_000)
+        assert False, "oversized image accepted"
+    except ValueError:
+        pass
+    finally:
+        cv2.imdecode = imdecode
+    print("✅ Uploads decoded in memory as BGR, capped in size, oversized images refused before decoding")
+    return True
+
+def test_background_index():
+    """Test that the index survives a reload and backgrounds load their pixels on first use"""
+    print("Testing background index...")
+    
+    with tempfile.TemporaryDirectory() as directory:
+        image = np.zeros((90, 160, 3), dtype=np.uint8)
+        image[..., 0] = 255  # Blue in BGR
+        for name in ('custom_old.png', 'custom_new.png'):
+            cv2.imwrite(os.path.join(directory, name), image)
+        
+        # Without a manifest, existing uploads are indexed from their files
+        manifest = os.path.join(directory, 'data', 'index.json')
+        os.makedirs(os.path.dirname(manifest))
+        index = BackgroundIndex(directory, manifest)
+        assert [(r.background_id, r.width, r.height) for r in index.load()] == [('custom_new', 160, 90),
+                                                                                ('custom_old', 160, 90)]
+        index.put(index.get('custom_new')._replace(references=3))
+        index.remove('custom_old')
+        index.save()
+        
+        # A file removed by hand drops its entry on the next load
+        index.put(BackgroundRecord('custom_gone', 'f' * 64, 'custom_gone.png', 1, 1))
+        index.save()
+        assert not os.path.exists(os.path.join(directory, 'index.json'))  # Nothing but images where they are served
+        reloaded = BackgroundIndex(directory, manifest).load()
+        assert [(r.background_id, r.references) for r in reloaded] == [('custom_new', 3)]
+        
+        # A malformed manifest, or one with fields this version does not know, is rebuilt from the files
+        for broken in ('{"backgrounds": [', '{"version": 1}', '{"backgrounds": [{"background_id": "x", "extra": 1}]}'):
+            with open(manifest, 'w') as output:
+                output.write(broken)
+            assert [r.background_id for r in BackgroundIndex(directory, manifest).load()] == ['custom_new',
+                                                                                            'custom_old']
+        with open(manifest) as rebuilt:
+            assert json.load(rebuilt)["backgrounds"][0]["background_id"] == 'custom_new'
+        
+        paged = BackgroundIndex(directory, manifest)
+        for i in range(5):
+            paged.put(BackgroundRecord(f'custom_{i}', f'{i}' * 64, f'custom_{i}.png', 1, 1))
+        assert [r.background_id for r in paged.page(2, 2)] == ['custom_2', 'custom_3']
+        assert [r.background_id for r in paged.page(4, 10)] == ['custom_4'] and paged.page(5, 10) == []
+        
+        replacer = BackgroundReplacer()
+        record = reloaded[0]
+        replacer.register_custom_background(record.background_id, index.file_path(record), record.references)
+        assert replacer.has_background('custom_new') and 'custom_new' not in replacer.custom_backgrounds
+        assert replacer.custom_background_stats()["loaded"] == 0
+        background = replacer.get_custom_background('custom_new', 320, 180)
+        assert background.shape == (180, 320, 3) and background[0, 0].tolist() == [255, 0, 0]
+        assert replacer.custom_background_stats()["loaded"] == 1
+        
+        # A delete landing while the first use is decoding must not bring the background back
+        replacer.register_custom_background('custom_race', index.file_path(record))
+        read = replacer._read_custom_background
+        def read_then_release(background_id, file_path):
+            image = read(background_id, file_path)
+            replacer.release_custom_background(background_id)
+            return image
+        replacer._read_custom_background = read_then_release
+        assert replacer.get_custom_background('custom_race', 320, 180) is None
+        assert not replacer.has_custom_background('custom_race')
+        assert 'custom_race' not in replacer.custom_background_refs
+    print("✅ Index reloaded from disk and paged in memory; pixels decoded on first use")
+    return True
+
+def test_stream_admission():
+    """Test the stream limit under the queue and reject policies"""
+    print("Testing stream admission...")
+    
+    async def run():
+        rejecting = StreamAdmission(max_streams=1, policy='reject')
+        assert await rejecting.admit()
+        assert not await rejecting.admit()
+        rejecting.release()
+        assert await rejecting.admit()
+        assert (rejecting.admitted, rejecting.rejected, rejecting.active) == (2, 1, 1)
+        
+        queueing = StreamAdmission(max_streams=1, policy='queue', queue_timeout=1.0)
+        assert await queueing.admit()
+        waiter = asyncio.create_task(queueing.admit())
+        await asyncio.sleep(0.05)
+        assert queueing.waiting == 1 and not waiter.done()
+        queueing.release()  # Handed straight to the waiting connection
+        assert await waiter
+        assert queueing.active == 1 and queueing.stats()["max_queue_ms"] >= 40
+        
+        queueing.queue_timeout = 0.05
+        assert not await queueing.admit()
+        assert (queueing.timed_out, queueing.rejected, queueing.waiting) == (1, 1, 0)
+    
+    asyncio.run(run())
+    print("✅ Streams beyond the limit are queued or rejected")
+    return True
+
+def test_fair_frame_scheduler():
+    """Test that a session with expensive frames cannot crowd out sessions with cheap ones"""
+    print("Testing fair frame scheduler...")
+    
+    async def run():
+        scheduler = FairFrameScheduler(slots=1)
+        frames = {"4k": 0, "480p-a": 0, "480p-b": 0}
+        costs = {"4k": 0.02, "480p-a": 0.005, "480p-b": 0.005}
+        
+        async def stream(session_id):
+            while True:
+                async with scheduler.slot(session_id):
+                    await asyncio.sleep(costs[session_id])
+                frames[session_id] += 1
+        
+        tasks = [asyncio.create_task(stream(session_id)) for session_id in frames]
+        await asyncio.sleep(0.5)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        
+        # Equal processing time: each cheap session gets several frames per expensive one
+        assert frames["480p-a"] > 2 * frames["4k"] and frames["480p-b"] > 2 * frames["4k"], frames
+        stats = scheduler.stats()
+        assert stats["busy"] == 0 and stats["waiting"] == 0, stats
+        return frames
+    
+    frames = asyncio.run(run())
+    print(f"✅ Frames per session with one slot: {frames}")
+    
+    # A frame cancelled mid-run (socket closed) keeps its slot until the pool has finished it
+    started, finish = threading.Event(), threading.Event()
+    def slow_frame(frame, session):
+        started.set()
+        finish.wait(5)
+        return frame
+    
+    async def cancel_running_frame():
+        replacer = BackgroundReplacer()
+        replacer.process_frame = slow_frame
+        executor = FrameExecutor(replacer, mode='thread', max_workers=1)
+        _, buffer = cv2.imencode('.jpg', np.zeros((48, 64, 3), dtype=np.uint8))
+        try:
+            task = asyncio.create_task(executor.process(buffer.tobytes(), StreamSession('blur')))
+            await asyncio.to_thread(started.wait, 5)
+            task.cancel()
+            await asyncio.sleep(0.05)
+            held = executor.scheduler.busy
+            finish.set()
+            await asyncio.gather(task, return_exceptions=True)
+            return held, executor.scheduler.busy
+        finally:
+            executor.shutdown()
+    
+    assert asyncio.run(cancel_running_frame()) == (1, 0)
+    print("✅ Cancelled frame holds its slot until the pool finishes it")
+    return True
+
+def test_stream_sessions():
+    """Test that background changes are scoped to one session"""
+    print("Testing stream sessions...")
+    
+    replacer = BackgroundReplacer()
+    first, second = StreamSession(), StreamSession()
+    assert replacer.set_background('office', first)
+    assert replacer.set_background('blur', second)
+    assert not replacer.set_background('missing', second)
+    assert (first.background, second.background, replacer.current_background) == ('office', 'blur', 'none')
+    
+    frame = np.random.randint(0, 255, (480, 640, 3), dtype=np.uint8)
+    assert replacer.process_frame(frame, first).shape == frame.shape
+    assert replacer.process_frame(frame, second).shape == frame.shape
+    print("✅ Sessions keep independent backgrounds on a shared replacer")
+    return True
+
+def test_quality_controller():
+    """Test that a session over its latency target trades quality for speed and recovers"""
+    print("Testing adaptive quality controller...")
+    
+    session = StreamSession()
+    controller = QualityController(cooldown=5)
+    
+    # No target: latency is tracked but nothing changes
+    assert all(controller.observe(session, 200.0) is None for _ in range(20))
+    assert (controller.level, session.output_quality) == (0, None)
+    
+    session.update_settings({'targetLatency': 50})
+    decisions = [d for d in (controller.observe(session, 120.0) for _ in range(40)) if d is not None]
+    assert controller.level == len(controller.levels) - 1 and len(decisions) == controller.level
+    assert decisions[0]["output_quality"] == QUALITY_LEVELS[1][0] and decisions[-1]["max_inference_width"] == 256
+    
+    decisions = [d for d in (controller.observe(session, 10.0) for _ in range(60)) if d is not None]
+    assert controller.level == 0 and (session.output_quality, session.max_inference_width) == (None, None)
+    
+    # Levels only lower the session's own settings, and level 0 gives them back
+    replacer = BackgroundReplacer(inference_width=320)
+    session = StreamSession()
+    session.update_settings({'targetLatency': 50, 'keyframeInterval': 6})
+    controller = QualityController(cooldown=1)
+    controller.observe(session, 120.0)
+    assert controller.level == 1 and replacer.inference_settings(session, 1280) == (320, 6)
+    for _ in range(len(controller.levels)):
+        controller.observe(session, 120.0)
+    assert replacer.inference_settings(session, 1280) == (256, 6)
+    assert replacer.inference_settings(session, 200) == (200, 6)
+    for _ in range(5 * len(controller.levels)):
+        controller.observe(session, 1.0)
+    assert controller.level == 0 and replacer.inference_settings(session, 1280) == (320, 6)
+    
+    # A client clock offset does not count as latency, but a growing one does
+    controller = QualityController(cooldown=5)
+    controller.observe(session, 10.0, client_timestamp=1_000.0, received=900.0)
+    controller.observe(session, 10.0, client_timestamp=2_000.0, received=901.0)
+    assert abs(controller.latency_ms - 10.0) < 1e-6
+    controller.observe(session, 10.0, client_timestamp=3_000.0, received=902.5)
+    assert controller.latency_ms > 10.0
+    
+    # Lower output quality means smaller replies
+    frame = cv2.GaussianBlur(np.random.randint(0, 255, (480, 640, 3), dtype=np.uint8), (5, 5), 0)
+    _, encoded = cv2.imencode('.jpg', frame)
+    replacer = BackgroundReplacer()
+    session = StreamSession()
+    full = process_encoded_frame(replacer, encoded.tobytes(), 'jpeg', session)
+    session.output_quality = 50
+    reduced = process_encoded_frame(replacer, encoded.tobytes(), 'jpeg', session)
+    assert len(reduced) < len(full)
+    print(f"✅ Quality stepped down and back up; replies at quality 50 are {len(reduced)} vs {len(full)} bytes")
+    return True
+
+def test_segmenter_pool():
+    """Test checkout/checkin semantics of the segmenter pool"""
+    print("Testing segmenter pool...")
+    
+    pool = SegmenterPool(object, size=2)
+    with pool.checkout() as first:
+        with pool.checkout() as second:
+            assert first is not second
+            assert pool.stats()["created"] == 2
+            
+            # A third checkout waits until one is checked back in
+            borrowed = []
+            waiter = threading.Thread(target=lambda: borrowed.append(pool.checkout().__enter__()))
+            waiter.start()
+            waiter.join(timeout=0.2)
+            assert not borrowed
+        waiter.join(timeout=2)
+        assert borrowed == [second]
+    
+    stats = pool.stats()
+    assert (stats["created"], stats["checkouts"], stats["waits"]) == (2, 3, 1)
+    print("✅ Segmenters created lazily up to the pool size and reused")
+    return True
+
+def _invert_and_count(replacer, frame, session, background_file):
+    """Worker handler for the shared-memory test: invert in place and count frames per session"""
+    session.state['frames'] = session.state.get('frames', 0) + 1
+    np.subtract(255, frame, out=frame)
+    frame[0, 0] = session.state['frames']
+    return frame
+
+def _ring_entries(replacer):
+    """Stats handler for the shared-memory test"""
+    return {"entries": len(replacer)}
+
+def test_shared_memory_worker_pool():
+    """Test frame handoff through shared memory and per-session worker state"""
+    print("Testing shared-memory worker pool...")
+    
+    pool = SharedMemoryWorkerPool(dict, _invert_and_count, workers=2, max_frame_bytes=480 * 640 * 3,
+                                  stats_handler=_ring_entries)
+    try:
+        session = StreamSession()
+        frame = np.random.randint(0, 255, (480, 640, 3), dtype=np.uint8)
+        for expected_count in (1, 2, 3):
+            with pool.process(frame, session) as result:
+                assert np.array_equal(result[1:], 255 - frame[1:])
+                assert result[0, 0, 0] == expected_count
+        assert not pool.fits(np.zeros((1080, 1920, 3), dtype=np.uint8))
+        assert pool.worker_stats() == [{"entries": 0}, {"entries": 0}]
+        print("✅ Frames composited in shared memory with session state kept in one worker")
+    finally:
+        pool.shutdown()
+    return True
+
+def _stall_or_exit(replacer, frame, session, background_file):
+    """Worker handler for the recovery test: sleep or die when the session asks to"""
+    if session.settings.get('exit'):
+        os._exit(1)
+    time.sleep(session.settings.get('stall', 0))
+    return frame
+
+def test_worker_pool_recovery():
+    """Test that timed-out slots come back with the late reply and dead workers are restarted"""
+    print("Testing shared-memory worker recovery...")
+    
+    pool = SharedMemoryWorkerPool(dict, _stall_or_exit, workers=1, slots_per_worker=2,
+                                  max_frame_bytes=64 * 64 * 3, timeout=60)
+    try:
+        frame = np.zeros((64, 64, 3), dtype=np.uint8)
+        session = StreamSession()
+        with pool.process(frame, session):
+            pass  # Worker is up
+        pool.timeout = 0.5
+        
+        session.update_settings({'stall': 1.0})
+        for _ in range(2):
+            try:
+                with pool.process(frame, session):
+                    pass
+                assert False, "Stalled frame should time out"
+            except RuntimeError as e:
+                assert "did not answer" in str(e)
+        deadline = time.time() + 5
+        while pool.stats()["free_slots"] < 2 and time.time() < deadline:
+            time.sleep(0.1)
+        assert pool.stats()["free_slots"] == 2 and pool.stats()["late_replies"] == 2
+        print("✅ Slots of timed-out frames returned when the late replies arrived")
+        
+        session.update_settings({'stall': 0, 'exit': True})
+        started = time.time()
+        try:
+            with pool.process(frame, session):
+                pass
+            assert False, "Frame on a dying worker should fail"
+        except RuntimeError as e:
+            assert "died" in str(e) or "did not answer" in str(e)
+        session.update_settings({'exit': False})
+        deadline = time.time() + 5
+        while pool.stats()["restarts"] == 0 and time.time() < deadline:
+            time.sleep(0.1)
+        detected = time.time() - started
+        pool.timeout = 60  # The replacement worker has to start up first
+        with pool.process(frame, session) as result:
+            assert result.shape == frame.shape
+        stats = pool.stats()
+        assert stats["restarts"] == 1 and stats["alive"] == 1 and stats["free_slots"] == 2
+        print(f"✅ Dead worker detected in {detected:.1f}s and restarted")
+    finally:
+        pool.shutdown()
+    return True
+
+def _worker_session_state(session_id):
+    """Runs in a frame pool process: the runtime state it keeps for a session"""
+    from main import _worker_session_states
+    return _worker_session_states.get(session_id)
+
+def test_process_executor_session_state():
+    """Test that process mode keeps each session's runtime state in one worker between frames"""
+    print("Testing process executor session state...")
+    
+    executor = FrameExecutor(BackgroundReplacer(), mode='process', max_workers=2)
+    try:
+        session = StreamSession('blur')
+        _, buffer = cv2.imencode('.jpg', np.random.randint(0, 255, (240, 320, 3), dtype=np.uint8))
+        for _ in range(3):
+            assert asyncio.run(executor.process(buffer.tobytes(), session)) is not None
+        assert session.state == {}  # Buffers stay in the worker, not in the server's copy
+        worker = executor.executor_for(session.session_id)
+        state = worker.submit(_worker_session_state, session.session_id).result()
+        assert state, "Worker should keep the session's keyframe and mask state"
+        
+        # /health reads the counters of the workers that did the segmenting
+        segmentation = combine_segmentation_stats([worker["segmentation"]
+                                                   for worker in asyncio.run(executor.worker_stats())])
+        assert segmentation["keyframes"] + segmentation["propagated_frames"] == 3
+        assert segmentation["per_frame_ms"] > 0
+        
+        executor.close_session(session)
+        assert worker.submit(_worker_session_state, session.session_id).result() is None
+        print("✅ Session pinned to one worker process with its state kept between frames")
+    finally:
+        executor.shutdown()
+    return True
+
+def test_pass_through_background():
+    """Test that the 'none' background skips inference and re-encoding"""
+    print("Testing pass-through background...")
+    
+    replacer = BackgroundReplacer()
+    session = StreamSession('none')
+    assert not replacer.requires_mask('none')
+    assert replacer.requires_mask('blur') and replacer.requires_mask('custom_anything')
+    
+    frame = np.random.randint(0, 255, (480, 640, 3), dtype=np.uint8)
+    assert replacer.process_frame(frame, session) is frame
+    assert replacer.segmenter_pool.stats()["created"] == 0
+    print("✅ No segmentation for 'none'")
+    
+    executor = FrameExecutor(replacer, mode='thread', max_workers=1)
+    try:
+        _, buffer = cv2.imencode('.jpg', frame)
+        frame_data = base64.b64encode(buffer).decode('utf-8')
+        assert asyncio.run(executor.process(frame_data, session)) is frame_data
+        assert executor.stats()["frames_passed_through"] == 1
+    finally:
+        executor.shutdown()
+    print("✅ Client bytes echoed without decode/encode")
+    return True
+
+def test_downscaled_inference():
+    """Test that downscaled inference returns full-size masks and frames"""
+    print("Testing downscaled inference...")
+    
+    frame = np.random.randint(0, 255, (720, 1280, 3), dtype=np.uint8)
+    for upsampling in ('bilinear', 'guided'):
+        replacer = BackgroundReplacer(inference_width=320, mask_upsampling=upsampling)
+        session = StreamSession('office')
+        mask = replacer.segment(frame, session)
+        assert mask.shape == (720, 1280) and mask.dtype == np.float32
+        assert 0.0 <= mask.min() and mask.max() <= 1.0
+        assert session.state['small'].shape == (180, 320, 3)
+        assert replacer.process_frame(frame, session).shape == frame.shape
+        print(f"✅ {upsampling} upsampling: 320x180 inference, {mask.shape[1]}x{mask.shape[0]} mask")
+    
+    session.update_settings({'inferenceWidth': 0})
+    replacer.segment(frame, session)
+    assert session.state['rgb'].shape == frame.shape
+    session.update_settings({'inferenceWidth': 8})
+    assert replacer.inference_settings(session, 1280)[0] == 64
+    session.update_settings({'inferenceWidth': -1})
+    assert session.inference_width == 64  # Invalid values are ignored
+    print("✅ inferenceWidth setting overrides the inference width per session")
+    return True
+
+def test_keyframe_segmentation():
+    """Test that masks are propagated between keyframes and scene changes force a keyframe"""
+    print("Testing keyframe segmentation...")
+    
+    replacer = BackgroundReplacer(keyframe_interval=1)
+    session = StreamSession('blur')
+    session.update_settings({'keyframeInterval': 3})
+    assert session.keyframe_interval == 3
+    
+    frame = np.full((480, 640, 3), 120, dtype=np.uint8)
+    cv2.circle(frame, (320, 300), 120, (40, 80, 160), -1)
+    for index in range(6):
+        mask = replacer.segment(np.roll(frame, 4 * index, axis=1), session)
+        assert mask is not None and mask.shape == (480, 640)
+    stats = replacer.segmentation_stats()
+    assert stats["keyframes"] == 2 and stats["propagated_frames"] == 4, stats
+    print(f"✅ 6 frames with K=3: {stats['keyframes']} keyframes, {stats['propagated_frames']} propagated")
+    
+    replacer.segment(255 - frame, session)
+    assert replacer.segmentation_stats()["keyframes"] == 3
+    print("✅ Scene change forces a keyframe")
+    return True
+
+def test_mask_smoothing():
+    """Test the per-session float16 running average of the mask"""
+    print("Testing temporal mask smoothing...")
+    
+    replacer = BackgroundReplacer(mask_decay=0.0)
+    session = StreamSession('blur')
+    ones = np.ones((90, 160), dtype=np.float32)
+    assert replacer._smooth_mask(ones, session) is ones
+    
+    session.update_settings({'maskDecay': 0.75})
+    assert session.mask_decay == 0.75
+    replacer._smooth_mask(ones, session)
+    average = session.state['mask_average']
+    assert average.dtype == np.float16
+    smoothed = replacer._smooth_mask(np.zeros_like(ones), session)
+    assert np.allclose(smoothed, 0.75) and np.allclose(average, 0.75)
+    smoothed = replacer._smooth_mask(np.zeros_like(ones), session)
+    assert np.allclose(smoothed, 0.5625, atol=1e-3)
+    assert session.state['mask_average'] is average
+    print("✅ Running average decays in place")
+    return True
+
+def test_soft_alpha_compositing():
+    """Test the fixed-point soft-alpha blend and the quality/edgeSmoothing settings"""
+    print("Testing soft alpha compositing...")
+    
+    frame = np.random.randint(0, 255, (200, 300, 3), dtype=np.uint8)
+    background = np.random.randint(0, 255, (200, 300, 3), dtype=np.uint8)
+    mask = np.zeros((200, 300), dtype=np.float32)
+    cv2.circle(mask, (150, 100), 70, 1.0, -1)
+    mask = cv2.GaussianBlur(mask, (0, 0), 4)
+    mask[0, 299] = 0.25  # A lone partial pixel in a corner tile
+    alpha = np.multiply(mask, 256, casting='unsafe', out=np.empty(mask.shape, np.uint16))
+    
+    result = BackgroundReplacer.composite_soft(frame, alpha, background, np.empty_like(frame))
+    weight = alpha[..., None].astype(np.float64)
+    expected = (frame * weight + background * (256 - weight)) / 256
+    assert np.abs(result - expected).max() <= 0.5
+    print("✅ Fixed-point blend matches the float reference")
+    
+    replacer = BackgroundReplacer()
+    session = StreamSession('office')
+    frame = np.random.randint(0, 255, (480, 640, 3), dtype=np.uint8)
+    assert replacer._edge_settings(session) == ('binary', 0)
+    for quality in ('medium', 'high', 'ultra'):
+        session.update_settings({'quality': quality, 'edgeSmoothing': 85})
+        assert replacer.process_frame(frame, session).shape == frame.shape
+    assert replacer._edge_settings(session) == ('guided', 85)
+    assert session.state['alpha'].dtype == np.uint16
+    print("✅ medium/high/ultra quality levels composite")
+    return True
+
+def test_pyramid_blur():
+    """Test blur strengths and reuse of the blurred background for a static camera"""
+    print("Testing pyramid blur...")
+    
+    replacer = BackgroundReplacer(blur_reuse_threshold=2.0)
+    frame = np.random.randint(0, 255, (720, 1280, 3), dtype=np.uint8)
+    detail = {}
+    for strength in ('low', 'medium', 'high'):
+        session = StreamSession('blur')
+        session.update_settings({'blurStrength': strength})
+        blurred = replacer.blur_background(frame, session)
+        assert blurred.shape == frame.shape
+        detail[strength] = cv2.Laplacian(blurred, cv2.CV_64F).var()
+    assert detail['low'] > detail['medium'] > detail['high']
+    print("✅ Stronger levels blur more")
+    
+    session = StreamSession('blur')
+    first = replacer.blur_background(frame, session).copy()
+    assert replacer.blur_reuses == 0
+    assert np.array_equal(replacer.blur_background(cv2.add(frame, np.ones_like(frame)), session), first)
+    assert replacer.blur_reuses == 1
+    assert not np.array_equal(replacer.blur_background(255 - frame, session), first)
+    assert replacer.blur_reuses == 1
+    print("✅ Static camera reuses the blurred background")
+    return True
+
+def test_onnx_segmenter():
+    """Test the ONNX Runtime backend against MediaPipe on the same input"""
+    print("Testing ONNX segmentation backend...")
+    
+    try:
+        segmenter_factory('tensorflow')
+        assert False, "unknown backend accepted"
+    except ValueError:
+        pass
+    
+    model_path = os.environ.get("ONNX_MODEL_PATH")
+    if segmentation.onnxruntime is None or not model_path:
+        print("⚠️  Skipped: needs onnxruntime and ONNX_MODEL_PATH (see convert_onnx_model.py)")
+        return True
+    
+    # Frames at the model's own size, so both backends see identical pixels
+    frame = np.full((144, 256, 3), 200, dtype=np.uint8)
+    cv2.ellipse(frame, (128, 144), (80, 50), 0, 180, 360, (140, 90, 60), -1)
+    cv2.circle(frame, (128, 70), 28, (200, 150, 120), -1)
+    batch = [frame, np.ascontiguousarray(frame[:, ::-1])]
+    
+    onnx_masks = segmenter_factory('onnx', model_path)().process(batch)
+    mediapipe_masks = MediaPipeSegmenter().process(batch)
+    for onnx_mask, mediapipe_mask in zip(onnx_masks, mediapipe_masks):
+        assert onnx_mask.shape == mediapipe_mask.shape == (144, 256)
+        assert np.abs(onnx_mask - mediapipe_mask).max() < 0.01
+    print("✅ ONNX masks match MediaPipe")
+    
+    masks = OnnxSegmenter(model_path).process([np.zeros((480, 640, 3), np.uint8), np.zeros((720, 1280, 3), np.uint8)])
+    assert [mask.shape for mask in masks] == [(480, 640), (720, 1280)]
+    print("✅ Masks returned at each frame's size")
+    return True
+
+class _RecordingSegmenter:
+    """Fake batch-capable segmenter that records the batch sizes it is given"""
+    
+    batch_sizes = []
+    
+    def process(self, batch):
+        self.batch_sizes.append(len(batch))
+        return [np.full(frame.shape[:2], frame[0, 0, 0] / 255, dtype=np.float32) for frame in batch]
+
+def test_inference_scheduler():
+    """Test that frames from concurrent sessions are segmented together and scattered back"""
+    print("Testing batched inference scheduler...")
+    
+    # A larger pool must not split the batches between idle segmenters
+    for pool_size in (1, 8):
+        _RecordingSegmenter.batch_sizes = []
+        scheduler = InferenceScheduler(SegmenterPool(_RecordingSegmenter, pool_size), deadline=0.2, max_batch=8)
+        try:
+            frames = [np.full((48, 64, 3), value, dtype=np.uint8) for value in range(10, 90, 10)]
+            results = {}
+            threads = [threading.Thread(target=lambda f=f: results.__setitem__(int(f[0, 0, 0]), scheduler.process(f)))
+                       for f in frames]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(timeout=5)
+            
+            # Each caller gets the mask for its own frame
+            assert sorted(results) == list(range(10, 90, 10))
+            assert all(np.allclose(mask, value / 255) for value, mask in results.items())
+            stats = scheduler.stats()
+            assert stats["frames"] == 8 and stats["batches"] <= 2, stats
+            assert max(_RecordingSegmenter.batch_sizes) >= 4
+            print(f"✅ Pool of {pool_size}: 8 concurrent frames ran in {stats['batches']} batch(es): "
+                  f"{stats['batch_sizes']}")
+        finally:
+            scheduler.shutdown()
+    return True
+
 def test_imports():
     """Test if all required modules can be imported"""
     print("Testing imports...")
@@ -87,7 +850,17 @@ def main():
     
     if imports_ok:
         # Test background replacer
-        replacer_ok = test_background_replacer()
+        replacer_ok = (test_background_replacer() and test_native_resolution_backgrounds()
+                       and test_background_cache() and test_binary_frame_protocol()
+                       and test_frame_mailbox() and test_decode_background() and test_background_index()
+                       and test_stream_admission() and test_fair_frame_scheduler() and test_stream_sessions()
+                       and test_quality_controller()
+                       and test_segmenter_pool() and test_shared_memory_worker_pool() and test_worker_pool_recovery()
+                       and test_process_executor_session_state()
+                       and test_pass_through_background() and test_downscaled_inference()
+                       and test_keyframe_segmentation() and test_mask_smoothing()
+                       and test_soft_alpha_compositing() and test_pyramid_blur() and test_onnx_segmenter()
+                       and test_inference_scheduler())
         
         if replacer_ok:
             print("\n🎉 All tests passed! The server is ready to run.")
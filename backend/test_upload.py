@@ -5,6 +5,8 @@ Test script to test the upload-background endpoint
 
 import requests
 import os
+import socket
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 import numpy as np
 
@@ -42,6 +44,45 @@ def test_upload():
             print(f"✅ Set uploaded background: {set_response.status_code}")
             print(f"   Response: {set_response.json()}")
         
+        # The same image again maps to the same background, counted twice
+        with open(test_file, 'rb') as f:
+            files = {'file': ('copy.jpg', f, 'image/jpeg')}
+            repeat = requests.post('http://localhost:8000/upload-background', files=files).json()
+        print(f"✅ Repeat upload deduplicated: {repeat.get('deduplicated')}, references: {repeat.get('references')}")
+        
+        # Each delete releases one upload; the file goes with the last one
+        for _ in range(2):
+            response = requests.delete(f"http://localhost:8000/background/{repeat['background_id']}")
+            print(f"✅ Delete: {response.status_code} {response.json()}")
+        
+        # Identical uploads in flight at the same time still share one background
+        with open(test_file, 'rb') as f:
+            content = f.read()
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(
+                lambda _: requests.post('http://localhost:8000/upload-background',
+                                        files={'file': ('same.jpg', content, 'image/jpeg')}).json(), range(4)))
+        print(f"✅ Concurrent identical uploads: {len({r['background_id'] for r in results})} background(s), "
+              f"{max(r['references'] for r in results)} references")
+        for result in results:
+            requests.delete(f"http://localhost:8000/background/{result['background_id']}")
+        
+        # Files that are not images are refused
+        files = {'file': ('not_an_image.jpg', b'not an image', 'image/jpeg')}
+        response = requests.post('http://localhost:8000/upload-background', files=files)
+        print(f"✅ Invalid image rejected: {response.status_code}")
+        
+        # Files above MAX_UPLOAD_MB are refused
+        files = {'file': ('huge.jpg', b'\0' * (21 * 1024 * 1024), 'image/jpeg')}
+        response = requests.post('http://localhost:8000/upload-background', files=files)
+        print(f"✅ Oversized upload rejected: {response.status_code}")
+        
+        # A request declaring an oversized body is refused before any of it is sent
+        with socket.create_connection(('localhost', 8000)) as connection:
+            connection.sendall(b"POST /upload-background HTTP/1.1\r\nHost: localhost\r\n"
+                               b"Content-Type: multipart/form-data; boundary=x\r\nContent-Length: 5000000000\r\n\r\n")
+            print(f"✅ Declared oversized upload rejected: {connection.recv(64).split(b' ')[1].decode()}")
+        
     except Exception as e:
         print(f"❌ Upload test failed: {e}")
     finally:
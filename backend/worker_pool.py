@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+Multi-process frame workers with shared-memory frame handoff
+
+Each worker process owns its own BackgroundReplacer (and so its own MediaPipe
+graph) and a shared-memory ring of frame slots. The server copies a decoded
+frame into a free slot and sends only a small control message; the worker
+composites in place and the server encodes straight from the slot, so pixel
+arrays are never pickled. Sessions are pinned to one worker so any
+per-session state stays in that worker.
+"""
+
+import itertools
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+import zlib
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# How long a caller waits for a worker before giving up on a frame
+WORKER_TIMEOUT = 10.0
+
+# How often the result dispatcher checks that the workers are still alive
+WORKER_CHECK_INTERVAL = 1.0
+
+
+def _worker_main(index: int, shm_name: str, slot_bytes: int, replacer_factory: Callable[[], Any],
+                 frame_handler: Callable[..., np.ndarray], stats_handler: Optional[Callable[[Any], Dict[str, Any]]],
+                 requests: Any, responses: Any) -> None:
+    """Worker process loop: composite frames in shared memory until told to stop"""
+    # Ctrl+C reaches the whole process group; the server stops workers itself via the request queue
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    replacer = replacer_factory()
+    sessions: Dict[str, Any] = {}
+    logger.info(f"Frame worker {index} ready")
+
+    try:
+        while True:
+            request = requests.get()
+            if request is None:
+                break
+
+            kind = request[0]
+            if kind == 'close':
+                sessions.pop(request[1], None)
+                continue
+            if kind == 'stats':
+                responses.put((request[1], None, stats_handler(replacer) if stats_handler else {}))
+                continue
+
+            _, job_id, slot, shape, session, background_file = request
+            try:
+                # Keep this worker's runtime state for the session; take fresh settings from the server
+                local = sessions.get(session.session_id)
+                if local is not None:
+                    session.state = local.state
+                sessions[session.session_id] = session
+
+                frame = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf, offset=slot * slot_bytes)
+                result = frame_handler(replacer, frame, session, background_file)
+                if result.shape != frame.shape:
+                    raise ValueError(f"Worker produced {result.shape}, expected {frame.shape}")
+                if result is not frame:
+                    np.copyto(frame, result)
+                responses.put((job_id, None, None))
+            except Exception as e:
+                responses.put((job_id, str(e), None))
+    finally:
+        shm.close()
+
+
+class SharedMemoryWorkerPool:
+    """Pool of frame worker processes fed through shared-memory ring buffers"""
+
+    def __init__(self, replacer_factory: Callable[[], Any], frame_handler: Callable[..., np.ndarray],
+                 workers: int, slots_per_worker: int = 2, max_frame_bytes: int = 1920 * 1080 * 3,
+                 timeout: float = WORKER_TIMEOUT, stats_handler: Optional[Callable[[Any], Dict[str, Any]]] = None):
+        """Start workers, each with slots_per_worker slots of max_frame_bytes
+
+        stats_handler, if given, is called with a worker's replacer to answer worker_stats().
+        """
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.slots_per_worker = max(1, slots_per_worker)
+        self.slot_bytes = max_frame_bytes
+        self.frames_processed = 0
+        self.late_replies = 0  # Replies that arrived after their caller timed out
+        self.restarts = 0  # Workers restarted after dying
+        self._replacer_factory = replacer_factory
+        self._frame_handler = frame_handler
+        self._stats_handler = stats_handler
+        self._closed = False
+
+        # Spawn rather than fork: MediaPipe's graph threads do not survive a fork
+        self._context = multiprocessing.get_context('spawn')
+        self._responses = self._context.Queue()
+        self._requests: List[Any] = []
+        self._rings: List[shared_memory.SharedMemory] = []
+        self._free_slots: List["queue.Queue[int]"] = []
+        self._processes: List[Any] = []
+        # Job ID -> (caller's future, worker, slot) until the worker replies; stats requests have no slot
+        self._pending: Dict[int, Tuple[Future, int, Optional[int]]] = {}
+        # Job ID -> (worker, slot) for jobs whose caller gave up; the slot comes back with the late reply
+        self._abandoned: Dict[int, Tuple[int, int]] = {}
+        self._pending_lock = threading.Lock()
+        self._job_ids = itertools.count()
+
+        for index in range(self.workers):
+            free_slots: "queue.Queue[int]" = queue.Queue()
+            for slot in range(self.slots_per_worker):
+                free_slots.put(slot)
+            self._rings.append(shared_memory.SharedMemory(create=True, size=self.slots_per_worker * self.slot_bytes))
+            self._free_slots.append(free_slots)
+            self._requests.append(None)
+            self._processes.append(None)
+            self._start_worker(index)
+
+        self._dispatcher = threading.Thread(target=self._dispatch_responses, name="frame-worker-results", daemon=True)
+        self._dispatcher.start()
+        logger.info(f"Shared-memory worker pool started: {self.workers} workers x {self.slots_per_worker} slots "
+                    f"of {self.slot_bytes / 1024 / 1024:.1f} MB")
+
+    def _start_worker(self, index: int) -> None:
+        """Start worker index with a fresh request queue on its existing ring"""
+        requests = self._context.Queue()
+        process = self._context.Process(
+            target=_worker_main, name=f"frame-worker-{index}", daemon=True,
+            args=(index, self._rings[index].name, self.slot_bytes, self._replacer_factory, self._frame_handler,
+                  self._stats_handler, requests, self._responses))
+        process.start()
+        self._requests[index] = requests
+        self._processes[index] = process
+
+    def _check_workers(self) -> None:
+        """Fail the jobs of dead workers, reclaim their slots and start replacements"""
+        for index, process in enumerate(self._processes):
+            if process.is_alive() or self._closed:
+                continue
+            logger.error(f"Frame worker {index} died (exit code {process.exitcode}); restarting it")
+            with self._pending_lock:
+                failed = [job_id for job_id, (_, worker, _) in self._pending.items() if worker == index]
+                futures = [self._pending.pop(job_id)[0] for job_id in failed]
+                abandoned = [job_id for job_id, (worker, _) in self._abandoned.items() if worker == index]
+                slots = [self._abandoned.pop(job_id)[1] for job_id in abandoned]
+                # Under the lock so no frame is queued for the dead worker after its jobs were failed
+                self._start_worker(index)
+                self.restarts += 1
+            # Callers hand back the slots of failed jobs; nobody waits on abandoned ones
+            for slot in slots:
+                self._free_slots[index].put(slot)
+            for future in futures:
+                future.set_exception(RuntimeError(f"Frame worker {index} died"))
+
+    def _dispatch_responses(self) -> None:
+        """Resolve the caller's future when a worker finishes a frame, and watch for dead workers"""
+        next_check = time.monotonic() + WORKER_CHECK_INTERVAL
+        while True:
+            try:
+                response = self._responses.get(timeout=WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                response = ()
+            if response is None:
+                break
+            if time.monotonic() >= next_check:
+                self._check_workers()
+                next_check = time.monotonic() + WORKER_CHECK_INTERVAL
+            if not response:
+                continue
+            job_id, error, result = response
+            with self._pending_lock:
+                entry = self._pending.pop(job_id, None)
+                late = self._abandoned.pop(job_id, None) if entry is None else None
+            if late is not None:
+                # The caller timed out but the worker is done with the slot: put it back in rotation
+                index, slot = late
+                self.late_replies += 1
+                self._free_slots[index].put(slot)
+                continue
+            if entry is None:
+                continue
+            future = entry[0]
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(RuntimeError(error))
+
+    def fits(self, frame: np.ndarray) -> bool:
+        """Check whether a frame fits in a ring slot"""
+        return frame.dtype == np.uint8 and frame.nbytes <= self.slot_bytes
+
+    def worker_for(self, session_id: str) -> int:
+        """Pin a session to a worker so its runtime state stays in one process"""
+        return zlib.crc32(session_id.encode()) % self.workers
+
+    @contextmanager
+    def process(self, frame: np.ndarray, session: Any, background_file: Optional[str] = None) -> Iterator[np.ndarray]:
+        """Composite a frame in the session's worker and yield a view of the result in shared memory
+
+        The view is only valid inside the with-block; encode or copy it before leaving.
+        """
+        if not self.fits(frame):
+            raise ValueError(f"Frame of {frame.nbytes} bytes does not fit a {self.slot_bytes}-byte slot")
+
+        index = self.worker_for(session.session_id)
+        try:
+            slot = self._free_slots[index].get(timeout=self.timeout)
+        except queue.Empty:
+            raise RuntimeError(f"No free frame slot on worker {index} after {self.timeout:g}s") from None
+        future: Future = Future()
+        job_id = next(self._job_ids)
+        owned = True  # Whether this caller still has to hand the slot back
+        try:
+            view = np.ndarray(frame.shape, dtype=np.uint8, buffer=self._rings[index].buf,
+                              offset=slot * self.slot_bytes)
+            np.copyto(view, frame)
+
+            with self._pending_lock:
+                self._pending[job_id] = (future, index, slot)
+                self._requests[index].put(('frame', job_id, slot, frame.shape, session, background_file))
+            try:
+                future.result(timeout=self.timeout)
+            except FutureTimeoutError:
+                with self._pending_lock:
+                    if self._pending.pop(job_id, None) is not None:
+                        # The worker may still write this slot; the dispatcher frees it when the reply arrives
+                        self._abandoned[job_id] = (index, slot)
+                        owned = False
+                if not owned:
+                    logger.error(f"Frame worker {index} timed out; slot {slot} waits for its late reply")
+                    raise RuntimeError(f"Frame worker {index} did not answer within {self.timeout:g}s") from None
+                future.result()  # Answered just as the wait ran out
+
+            self.frames_processed += 1
+            yield view
+        finally:
+            with self._pending_lock:
+                self._pending.pop(job_id, None)
+            if owned:
+                self._free_slots[index].put(slot)
+
+    def close_session(self, session_id: str) -> None:
+        """Drop a finished session's state in its worker"""
+        self._requests[self.worker_for(session_id)].put(('close', session_id))
+
+    def worker_stats(self, timeout: float = 2.0) -> List[Optional[Dict[str, Any]]]:
+        """Ask every worker for its stats_handler result; None for a worker that does not answer in time"""
+        futures: List[Tuple[int, Future]] = []
+        with self._pending_lock:
+            for index, requests in enumerate(self._requests):
+                job_id, future = next(self._job_ids), Future()
+                self._pending[job_id] = (future, index, None)
+                requests.put(('stats', job_id))
+                futures.append((job_id, future))
+
+        deadline = time.monotonic() + timeout
+        results: List[Optional[Dict[str, Any]]] = []
+        for job_id, future in futures:
+            try:
+                results.append(future.result(timeout=max(0.0, deadline - time.monotonic())))
+            except Exception:
+                results.append(None)
+            finally:
+                with self._pending_lock:
+                    self._pending.pop(job_id, None)
+        return results
+
+    def stats(self) -> Dict[str, Any]:
+        """Return pool settings and counters for monitoring"""
+        return {
+            "workers": self.workers,
+            "alive": sum(process.is_alive() for process in self._processes),
+            "restarts": self.restarts,
+            "slots_per_worker": self.slots_per_worker,
+            "free_slots": sum(free_slots.qsize() for free_slots in self._free_slots),
+            "slot_bytes": self.slot_bytes,
+            "frames_processed": self.frames_processed,
+            "late_replies": self.late_replies,
+        }
+
+    def shutdown(self) -> None:
+        """Stop the workers and release the shared memory"""
+        self._closed = True
+        for requests in self._requests:
+            requests.put(None)
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        # Let the dispatcher drain and exit before the queues and rings go away
+        self._responses.put(None)
+        self._dispatcher.join(timeout=5)
+        for requests in self._requests:
+            requests.close()
+        self._responses.close()
+        for ring in self._rings:
+            ring.close()
+            ring.unlink()